@@ -7,10 +7,8 @@ Stanford University) in the tflow.py module of the AMP package.
 """
 from sklearn.base import BaseEstimator, ClassifierMixin
 import tensorflow as tf
+import TFSession
 import numpy as np
-import matplotlib.pyplot as plt
-import pandas as pd
-import seaborn as sns
 from sklearn.metrics import r2_score
 from sklearn.metrics import mean_squared_error
 from sklearn.metrics import mean_absolute_error
@@ -22,9 +20,45 @@ class BPNN(BaseEstimator, ClassifierMixin):
     of how many features correspond to that atom.
 
     :labels: list of length (2*n_atoms,) containing strings and int
+
+    The training can be stopped early when the root mean square error on a validation set stops improving. The
+    validation set is a fraction validation_fraction of the training set, chosen at random, that is not used for
+    training. The training stops after patience iterations without a decrease of the validation error larger than
+    min_delta and the weights that gave the lowest validation error are kept.
+
+    :early_stopping: bool, default False
+    :validation_fraction: float, default 0.1
+    :patience: int, default 10
+    :min_delta: float, default 0.0
+    :random_state: int or None, default None - seed used to pick the validation set
+
+    Histograms of the weights can be written for TensorBoard during the training. This is off by default, since it
+    slows down the training. When summary_dir is set, the summaries are calculated every summary_interval mini-batches
+    in the same call as the training step.
+
+    :summary_dir: string or None, default None - directory where the TensorBoard summaries are written
+    :summary_interval: int, default 100
+
+    The number of threads used by TensorFlow can be limited, so that several estimators can be trained at the same time
+    on one machine without competing for the cores. A value of 0 lets TensorFlow choose. The process can also be pinned
+    to some CPUs (with psutil).
+
+    :intra_op_threads: int, default 0 - threads used to run a single operation
+    :inter_op_threads: int, default 0 - threads used to run independent operations at the same time
+    :cpu_affinity: list of int or None, default None - CPUs to which the process is pinned when a session is opened
+        (needs psutil)
+
+    The features of each element can be standardised inside the graph, so that the same scaling is used for the
+    training, the predictions and the forces. The scalers can be fitted while the symmetry functions are generated, with
+    SymmetryFunctions.generate(scaler={element: StreamingScaler(), ...}).
+
+    :scaler: dictionary or None, default None - the key is the atom label and the value is a fitted
+        Scaling.StreamingScaler for the features of the atoms of that element
     """
     def __init__(self, hidden_layer_sizes=(5,), alpha=0.0001, batch_size='auto', learning_rate_init=0.001,
-                 max_iter=80, labels=(0,)):
+                 max_iter=80, labels=(0,), early_stopping=False, validation_fraction=0.1, patience=10, min_delta=0.0,
+                 random_state=None, summary_dir=None, summary_interval=100, intra_op_threads=0, inter_op_threads=0,
+                 cpu_affinity=None, scaler=None):
 
         # Initialising the parameters
         self.alpha = alpha
@@ -37,6 +71,17 @@ class BPNN(BaseEstimator, ClassifierMixin):
             self.labels = [('N', 4), ('C', 4), ('C', 4), ('H', 4), ('H', 4), ('H', 4), ('H', 4)]
         else:
             self.labels = labels
+        self.early_stopping = early_stopping
+        self.validation_fraction = validation_fraction
+        self.patience = patience
+        self.min_delta = min_delta
+        self.random_state = random_state
+        self.summary_dir = summary_dir
+        self.summary_interval = summary_interval
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.cpu_affinity = cpu_affinity
+        self.scaler = scaler
 
     def fit(self, X, y):
         """
@@ -45,31 +90,24 @@ class BPNN(BaseEstimator, ClassifierMixin):
         :X: numpy array of shape (n_samples, n_features)
         :y: array of shape (n_samples,)
         """
+        # Modifying shape of y to be compatible with tensorflow and creating a placeholder
+        y = np.reshape(y, (len(y), 1))
+
+        if self.early_stopping:
+            X, y, X_val, y_val = self.__split_validation(X, y)
+
         # Some useful data
         self.n_samples = X.shape[0]
         self.checkBatchSize()
 
-        # Modifying shape of y to be compatible with tensorflow and creating a placeholder
-        y = np.reshape(y, (len(y), 1))
-
         with tf.name_scope('input_y'):
             y_tf = tf.placeholder(tf.float32, [None, 1])
 
-        # # Splitting the X into the different descriptors
-        # X_input = self.__split_input(X)
-
         # Making a list of the unique elements and one of all the elements in order
         self.unique_ele, self.all_atoms = self.__unique_elements()
 
-        # Create a list of tensorflow placeholders, one item per atom in the system
-        inputs = []
-
-        with tf.name_scope('input_x'):
-            for ii in range(0, len(self.labels)):
-                inputs.append(tf.placeholder(tf.float32, [None, self.labels[ii][1]]))
-
-        # Zipping the placeholders and the labels, so it is easy to know which weights to call
-        data = zip(self.all_atoms, inputs)
+        # Create a dictionary of tensorflow placeholders, one item per element. Each row is the descriptor of one atom.
+        inputs = self.__element_placeholders()
 
         # Declaring the weights
         with tf.name_scope('weights'):
@@ -81,23 +119,14 @@ class BPNN(BaseEstimator, ClassifierMixin):
                 all_weights[key] = weights
                 all_biases[key] = biases
 
-                tf.summary.histogram("weights_in", weights[0])
-                for ii in range(len(self.hidden_layer_sizes) - 1):
-                    tf.summary.histogram("weights_hidden", weights[ii + 1])
-                tf.summary.histogram("weights_out", weights[-1])
+                if self.summary_dir is not None:
+                    tf.summary.histogram("weights_in", weights[0])
+                    for ii in range(len(self.hidden_layer_sizes) - 1):
+                        tf.summary.histogram("weights_hidden", weights[ii + 1])
+                    tf.summary.histogram("weights_out", weights[-1])
 
         # Evaluating the model
-        with tf.name_scope("atom_nn"):
-            all_atom_ene = []
-            for ii in range(len(self.all_atoms)):
-                atom_ene = self.__atom_energy(data[ii], all_weights, all_biases)
-                all_atom_ene.append(atom_ene)
-
-        # Summing the results to get the total energy
-        with tf.name_scope("tot_ene"):
-            model_tot = all_atom_ene[0]
-            for ii in range(len(all_atom_ene)-1):
-                model_tot = tf.add(all_atom_ene[ii+1], model_tot)
+        model_tot = self.__total_energy(inputs, all_weights, all_biases)
 
         # Calculating the cost function with L2 regularisation term
         with tf.name_scope('cost'):
@@ -110,14 +139,28 @@ class BPNN(BaseEstimator, ClassifierMixin):
 
         # Initialisation of the model
         init = tf.global_variables_initializer()
-        merged_summary = tf.summary.merge_all()
+        if self.summary_dir is not None:
+            merged_summary = tf.summary.merge_all()
 
-        with tf.Session() as sess:
+        with TFSession.new_session(None, self.intra_op_threads, self.inter_op_threads, self.cpu_affinity) as sess:
             self.cost_list = []
-            summary_writer = tf.summary.FileWriter(logdir="/Users/walfits/Repositories/trainingNN/tensorboard", graph=sess.graph)
+            if self.summary_dir is not None:
+                summary_writer = tf.summary.FileWriter(logdir=self.summary_dir, graph=sess.graph)
             sess.run(init)
 
-            for i in range(self.max_iter):
+            # Total number of mini-batches done, used as the step of the summaries
+            global_step = 0
+
+            best_rmse = np.inf
+            n_no_improvement = 0
+            self.val_rmse_list = []
+            # The initial weights are the best ones until the validation error improves, so that there are always
+            # weights to restore at the end (also if the validation error is never finite)
+            if self.early_stopping:
+                best_weights, best_biases = sess.run([all_weights, all_biases])
+                self.best_iteration = None
+
+            for iter in range(self.max_iter):
                 # This is the total number of batches in which the training set is divided
                 n_batches = int(self.n_samples / self.batch_size)
                 # This will be used to calculate the average cost per iteration
@@ -126,27 +169,52 @@ class BPNN(BaseEstimator, ClassifierMixin):
                 for i in range(n_batches):
                     batch_x = X[i * self.batch_size:(i + 1) * self.batch_size, :]
                     batch_y = y[i * self.batch_size:(i + 1) * self.batch_size, :]
-                    X_batch = self.__split_input(batch_x)
-                    feeddict = {i: d for i, d in zip(inputs, X_batch)}
+                    feeddict = self.__feed_dict(inputs, batch_x)
                     feeddict[y_tf] = batch_y
-                    opt, c = sess.run([optimiser, cost], feed_dict=feeddict)
+                    if self.summary_dir is not None and global_step % self.summary_interval == 0:
+                        opt, c, summary = sess.run([optimiser, cost, merged_summary], feed_dict=feeddict)
+                        summary_writer.add_summary(summary, global_step)
+                    else:
+                        opt, c = sess.run([optimiser, cost], feed_dict=feeddict)
                     avg_cost += c / n_batches
-                    summary = sess.run(merged_summary, feed_dict=feeddict)
-                    summary_writer.add_summary(summary, i)
+                    global_step += 1
                 self.cost_list.append(avg_cost)
 
-
-            self.all_weights = {}
-            self.all_biases = {}
-
-            for key, value in self.unique_ele.iteritems():
-                w = []
-                b = []
-                for ii in range(len(all_weights[key])):
-                    w.append(sess.run(all_weights[key][ii]))
-                    b.append(sess.run(all_biases[key][ii]))
-                self.all_weights[key]  = w
-                self.all_biases[key] = b
+                if self.early_stopping:
+                    feeddict = self.__feed_dict(inputs, X_val)
+                    y_pred = sess.run(model_tot, feed_dict=feeddict)
+                    rmse = np.sqrt(np.mean((y_pred - y_val) ** 2))
+                    self.val_rmse_list.append(rmse)
+                    if np.isfinite(rmse) and rmse < best_rmse - self.min_delta:
+                        # Keeping a copy of the best weights found so far
+                        best_rmse = rmse
+                        n_no_improvement = 0
+                        best_weights, best_biases = sess.run([all_weights, all_biases])
+                        self.best_iteration = iter
+                    else:
+                        n_no_improvement += 1
+                        if n_no_improvement >= self.patience:
+                            print "Stopping early after " + str(iter + 1) + " iterations."
+                            break
+
+            if self.summary_dir is not None:
+                summary_writer.close()
+
+            if self.early_stopping:
+                self.all_weights = best_weights
+                self.all_biases = best_biases
+            else:
+                self.all_weights = {}
+                self.all_biases = {}
+
+                for key, value in self.unique_ele.iteritems():
+                    w = []
+                    b = []
+                    for ii in range(len(all_weights[key])):
+                        w.append(sess.run(all_weights[key][ii]))
+                        b.append(sess.run(all_biases[key][ii]))
+                    self.all_weights[key]  = w
+                    self.all_biases[key] = b
 
     def predict(self, X):
         """
@@ -162,21 +230,11 @@ class BPNN(BaseEstimator, ClassifierMixin):
 
         """
 
-        # Splitting the X into the different descriptors
-        X_input = self.__split_input(X)
-
         # Making a list of the unique elements and one of all the elements in order
         self.unique_ele, self.all_atoms = self.__unique_elements()
 
-        # Create a list of tensorflow placeholders, one item per atom in the system
-        inputs = []
-
-        with tf.name_scope('input_x'):
-            for ii in range(0, len(self.labels)):
-                inputs.append(tf.placeholder(tf.float32, [None, self.labels[ii][1]]))
-
-        # Zipping the placeholders and the labels, so it is easy to know which weights to call
-        data = zip(self.all_atoms, inputs)
+        # Create a dictionary of tensorflow placeholders, one item per element
+        inputs = self.__element_placeholders()
 
         # Making the weights into tf.variables
         all_weights = {}
@@ -192,30 +250,88 @@ class BPNN(BaseEstimator, ClassifierMixin):
             all_biases[key] = b
 
         # Evaluating the model
-        with tf.name_scope("atom_nn"):
-            all_atom_ene = []
-            for ii in range(len(self.all_atoms)):
-                atom_ene = self.__atom_energy(data[ii], all_weights, all_biases)
-                all_atom_ene.append(atom_ene)
-
-        # Summing the results to get the total energy
-        with tf.name_scope("tot_ene"):
-            model_tot = all_atom_ene[0]
-            for ii in range(len(all_atom_ene) - 1):
-                model_tot = tf.add(all_atom_ene[ii + 1], model_tot)
+        model_tot = self.__total_energy(inputs, all_weights, all_biases)
 
         # Initialising variables
         init = tf.global_variables_initializer()
 
-        with tf.Session() as sess:
+        with TFSession.new_session(None, self.intra_op_threads, self.inter_op_threads, self.cpu_affinity) as sess:
             sess.run(init)
-            feeddict = {i: d for i, d in zip(inputs, X_input)}
+            feeddict = self.__feed_dict(inputs, X)
             pred = sess.run(model_tot, feed_dict=feeddict)
             predictions = np.reshape(pred, (pred.shape[0],))
 
         print pred
         return predictions
 
+    def predict_forces(self, coord, descriptor):
+        """
+        This function calculates the total energies and the forces acting on the atoms for a batch of configurations.
+        The forces are minus the gradient of the total energy with respect to the cartesian coordinates. The gradient
+        is calculated analytically by TensorFlow through both the element networks and the descriptor, so the energies
+        and the forces of all the configurations are obtained in one pass.
+
+        :coord: array of shape (n_samples, n_atoms, 3) with the coordinates of the atoms, in the same order as labels
+        :descriptor: function that takes a tf.Tensor of coordinates of shape (n_samples, n_atoms, 3) and returns the
+            descriptor used to train the network as a tf.Tensor of shape (n_samples, n_features), with the features of
+            each atom in the order given by labels. For example, the function tf_descriptor of a SymmetryFunctions
+            object.
+        :return: array of shape (n_samples, 1) with the energies and array of shape (n_samples, n_atoms, 3) with the
+            forces
+        """
+        coord = np.asarray(coord, dtype=np.float32)
+        if coord.ndim != 3 or coord.shape[2] != 3:
+            raise ValueError("The coordinates should have shape (n_samples, n_atoms, 3), got %s." % (coord.shape,))
+
+        graph = tf.Graph()
+
+        with graph.as_default():
+            coord_tf = tf.placeholder(tf.float32, [None, coord.shape[1], 3])
+            energy, forces = self.forces_graph(coord_tf, descriptor)
+
+        with TFSession.new_session(graph, self.intra_op_threads, self.inter_op_threads, self.cpu_affinity) as sess:
+            return sess.run([energy, forces], feed_dict={coord_tf: coord})
+
+    def forces_graph(self, coord, descriptor):
+        """
+        This function adds to the default graph the operations that calculate the total energies and the forces for the
+        tensor of coordinates coord, with the weights as constants (as in inference_graph). The forces are calculated
+        in the same way as in MLPRegFlow.forces_graph.
+
+        :coord: tf.Tensor of shape (n_samples, n_atoms, 3)
+        :descriptor: function that takes coord and returns the descriptor as a tf.Tensor of shape
+            (n_samples, n_features), with the features of each atom in the order given by labels
+        :return: tf.Tensor of shape (n_samples, 1) with the energies and tf.Tensor of shape (n_samples, n_atoms, 3) with
+            the forces
+        """
+        energy = self.inference_graph(descriptor(coord))
+        forces = tf.negative(tf.gradients(tf.reduce_sum(energy), coord)[0])
+
+        return energy, forces
+
+    def inference_graph(self, X):
+        """
+        This function adds to the default graph the operations that calculate the total energy predicted by the trained
+        network for the tensor X. The weights are constants, so the graph doesn't need to be initialised and can be
+        exported as a frozen graph (see Export.export_model).
+
+        :X: tf.Tensor of shape (n_samples, n_features), with the features of each atom in the order given by labels
+        :return: tf.Tensor of shape (n_samples, 1)
+        """
+        if not hasattr(self, 'all_weights'):
+            raise AttributeError("The fit function has not been called yet, so the model has not been trained yet.")
+
+        self.unique_ele, self.all_atoms = self.__unique_elements()
+        inputs = self.__split_tensor(X)
+
+        all_weights = {}
+        all_biases = {}
+        for key in self.unique_ele:
+            all_weights[key] = [tf.constant(w, dtype=tf.float32) for w in self.all_weights[key]]
+            all_biases[key] = [tf.constant(b, dtype=tf.float32) for b in self.all_biases[key]]
+
+        return self.__total_energy(inputs, all_weights, all_biases)
+
     def plot_cost(self):
         """
         This function plots the cost as a function of training iterations. It can only be called after the model has
@@ -229,6 +345,8 @@ class BPNN(BaseEstimator, ClassifierMixin):
             raise AttributeError("No values for the cost. Make sure that the model has been trained with the function "
                             "fit().")
 
+        import matplotlib.pyplot as plt
+
         fig, ax = plt.subplots(figsize=(6, 6))
         ax.plot(self.cost_list, label="Train set", color="b")
         ax.set_xlabel('Number of iterations')
@@ -258,6 +376,10 @@ class BPNN(BaseEstimator, ClassifierMixin):
 
             These are the limits of the x values for the plot.
         """
+        import matplotlib.pyplot as plt
+        import pandas as pd
+        import seaborn as sns
+
         y_pred = self.predict(X)
         df = pd.DataFrame()
         df['High level calculated energies (Ha)'] = y
@@ -311,19 +433,65 @@ class BPNN(BaseEstimator, ClassifierMixin):
 
         return weights, biases
 
-    def __atom_energy(self, zip_data, all_weights, all_biases):
+    def __element_placeholders(self):
+        """
+        This function creates one placeholder for each element. The descriptors of all the atoms of that element in a
+        batch are stacked in the rows of the placeholder.
+
+        :return: dictionary where the key is the atom label and the value is a tf.placeholder of shape
+            (n_samples*n_atoms_of_element, n_features_of_element)
+        """
+        inputs = {}
+
+        with tf.name_scope('input_x'):
+            for key, value in self.unique_ele.items():
+                inputs[key] = tf.placeholder(tf.float32, [None, value], name="input_" + key)
+
+        return inputs
+
+    def __total_energy(self, inputs, all_weights, all_biases):
+        """
+        This function calculates the total energy of each sample. The network of each element is evaluated once on all
+        the atoms of that element and the atomic energies are then added up for each sample with a segment sum.
+
+        :inputs: dictionaries where the key is the atom label and the value is a tf.placeholder with the stacked
+            descriptors of all the atoms of that element
+        :all_weights: Dictionaries where the key is the atom label and the value is a list of weights (of length [n_hidden_layers+1,].
+        :all_biases: Dictionaries where the key is the atom label and the value is a list of biases (of length [n_hidden_layers+1,].
+        :return: tf.tensor of shape (n_samples, 1)
+        """
+        all_atom_ene = []
+        sample_idx = []
+
+        with tf.name_scope("atom_nn"):
+            for key in sorted(inputs.keys()):
+                n_atoms_ele = self.all_atoms.count(key)
+                all_atom_ene.append(self.__atom_energy(key, inputs[key], all_weights, all_biases))
+                # The rows of the stacked input are ordered by sample, with n_atoms_ele atoms per sample
+                sample_idx.append(tf.range(tf.shape(inputs[key])[0]) // n_atoms_ele)
+                n_samples = tf.shape(inputs[key])[0] // n_atoms_ele
+
+        with tf.name_scope("tot_ene"):
+            model_tot = tf.unsorted_segment_sum(tf.concat(all_atom_ene, axis=0), tf.concat(sample_idx, axis=0),
+                                                n_samples)
+
+        return model_tot
+
+    def __atom_energy(self, label, tf_input, all_weights, all_biases):
         """
-        This function calculates the single atom energy with the single atom neural networks. It uses zip_data, which
-        contains the tf placeholders for an atom and its corresponding atom label. all_weights/all_biases are all
-        the weights/biases and their label.
+        This function calculates the single atom energies of all the atoms of one element with the network of that
+        element. all_weights/all_biases are all the weights/biases and their label.
 
-        :zip_data: a two item list where the first item is the atom label (string) and the second is a tf.placeholder
+        :label: atom label (string)
+        :tf_input: tf.placeholder of shape (n_samples*n_atoms_of_element, n_features_of_element)
         :all_weights: Dictionaries where the key is the atom label and the value is a list of weights (of length [n_hidden_layers+1,].
         :all_biases: Dictionaries where the key is the atom label and the value is a list of biases (of length [n_hidden_layers+1,].
-        :return: tf.tensor containing the activation of the output layer.
+        :return: tf.tensor of shape (n_samples*n_atoms_of_element, 1) containing the activation of the output layer.
         """
-        label = zip_data[0]
-        tf_input = zip_data[1]
+        # Standardising the features with the scaler of the element
+        if self.scaler is not None and label in self.scaler:
+            tf_input = (tf_input - tf.constant(self.scaler[label].mean_, dtype=tf_input.dtype)) / \
+                       tf.constant(self.scaler[label].scale_, dtype=tf_input.dtype)
 
         # Obtaining the index of the weights that correspond to the right atom
         z = tf.add(tf.matmul(tf_input, tf.transpose(all_weights[label][0])), all_biases[label][0])
@@ -339,23 +507,84 @@ class BPNN(BaseEstimator, ClassifierMixin):
 
     def __split_input(self, X):
         """
-        This function takes the data where the descriptor of all the atoms are concatenated into one line. It then splits
-        it into n_atoms different data sets that will all be fed into a different mini-network.
+        This function takes the data where the descriptor of all the atoms are concatenated into one line, in the order
+        given by labels. It then splits it into one data set per element, where the descriptors of all the atoms of that
+        element are stacked, so that each element network is evaluated with one matrix multiplication.
 
         :X: numpy array of shape (n_samples, n_features_tot)
-        :return: list of numpy array of shape (n_samples, n_features)
+        :return: dictionary where the key is the atom label and the value is a numpy array of shape
+            (n_samples*n_atoms_of_element, n_features_of_element)
         """
-        split_X = []
+        idx_ele = {}
 
         counter = 0
         for ii in range(0, len(self.labels)):
-            idx1 = counter
-            idx2 = counter + self.labels[ii][1]
-            split_X.append(X[:,idx1:idx2])
+            idx_ele.setdefault(self.labels[ii][0], []).append(range(counter, counter + self.labels[ii][1]))
             counter = counter + self.labels[ii][1]
 
+        split_X = {}
+        for key, idx in idx_ele.items():
+            idx = np.asarray(idx)
+            # Shape (n_samples, n_atoms_of_element, n_features_of_element) reshaped so that each row is one atom
+            split_X[key] = np.asarray(X)[:, idx].reshape((-1, idx.shape[1]))
+
         return split_X
 
+    def __split_tensor(self, X):
+        """
+        This function does the same as __split_input, but on a tensor, so that the descriptor can be calculated in the
+        same graph as the network.
+
+        :X: tf.Tensor of shape (n_samples, n_features_tot)
+        :return: dictionary where the key is the atom label and the value is a tf.Tensor of shape
+            (n_samples*n_atoms_of_element, n_features_of_element)
+        """
+        idx_ele = {}
+
+        counter = 0
+        for ii in range(0, len(self.labels)):
+            idx_ele.setdefault(self.labels[ii][0], []).append(range(counter, counter + self.labels[ii][1]))
+            counter = counter + self.labels[ii][1]
+
+        split_X = {}
+        for key, idx in idx_ele.items():
+            idx = np.asarray(idx)
+            split_X[key] = tf.reshape(tf.gather(X, idx.ravel(), axis=1), [-1, idx.shape[1]])
+
+        return split_X
+
+    def __feed_dict(self, inputs, X):
+        """
+        This function makes the feed dictionary for the element placeholders from the data X.
+
+        :inputs: dictionary where the key is the atom label and the value is a tf.placeholder
+        :X: numpy array of shape (n_samples, n_features_tot)
+        :return: dictionary
+        """
+        split_X = self.__split_input(X)
+
+        return {inputs[key]: split_X[key] for key in inputs}
+
+    def __split_validation(self, X, y):
+        """
+        This function picks at random a fraction validation_fraction of the samples to use as validation set for early
+        stopping.
+
+        :X: numpy array of shape (n_samples, n_features)
+        :y: numpy array of shape (n_samples, 1)
+        :return: X and y for training and X and y for validation
+        """
+        n_val = int(np.ceil(self.validation_fraction * X.shape[0]))
+        if n_val < 1 or n_val >= X.shape[0]:
+            raise ValueError("The validation fraction %s leaves no samples for training or for validation."
+                             % (self.validation_fraction))
+
+        permutation = np.random.RandomState(self.random_state).permutation(X.shape[0])
+        idx_train = permutation[n_val:]
+        idx_val = permutation[:n_val]
+
+        return X[idx_train], y[idx_train], X[idx_val], y[idx_val]
+
     def __reg_cost(self, nn_energy, qm_energy, all_weights):
         """
         This function calculates the cost function with L2 regularisation. It requires the energies predicted by the
@@ -1,6 +1,9 @@
 import numpy as np
 from numpy import linalg as LA
 from scipy.special import factorial
+from scipy import sparse
+from sklearn.utils import check_random_state
+import NeighbourList
 
 class CoulombMatrix():
     """This class contains the functions required to generate the following variations of  Coulomb matrices (with nuclear charges) for M configurations of N atoms:
@@ -16,13 +19,22 @@ class CoulombMatrix():
 
     When it is initialised, the raw data of each configuration with atom labels and their xyz coordinates is passed.
 
+    For large systems, a cut off radius can be given. In this case only the elements of the pairs of atoms closer than
+    r_cut are calculated (using a neighbour list) and the standard matrix is stored as a scipy sparse matrix.
+
     :matrixX: list of lists, where each of the inner lists represents a sample configuration. An example is shown below: [ [ 'C', 0.1, 0.3, 0.5, 'H', 0.0, 0.5 1.0, 'H', 0.0, -0.5, -1.0, ....], [...], ... ].
+    :r_cut: float, default None - cut off radius. If None, all the pairs of atoms are used.
+    :skin: float, default 0.0 - skin of the neighbour list, used when consecutive samples are frames of a trajectory
+    :dtype: numpy dtype of the descriptors, default np.float64. With np.float32 the descriptors take half the memory
+        and can be passed to the estimators without being converted.
 
     """
 
-    def __init__(self, matrixX):
+    def __init__(self, matrixX, r_cut=None, skin=0.0, dtype=np.float64):
 
         self.rawX = matrixX
+        self.r_cut = r_cut
+        self.dtype = dtype
         self.Z = {
                     'C': 6.0,
                     'H': 1.0,
@@ -33,8 +45,11 @@ class CoulombMatrix():
         self.n_samples = len(self.rawX)
 
 
-        self.coulMatrix = np.zeros((self.n_samples, self.n_atoms**2))
-        self.__generateCM()
+        if r_cut is None:
+            self.coulMatrix = np.zeros((self.n_samples, self.n_atoms**2), dtype=self.dtype)
+            self.__generateCM()
+        else:
+            self.coulMatrix = self.__generateSparseCM(r_cut, skin)
 
         print "Initialised the Coulomb matrix. \n"
 
@@ -42,7 +57,7 @@ class CoulombMatrix():
         """
         This function returns the standard Coulomb matrix. Each line is the flattened matrix for each sample.
 
-        :return: numpy array of shape (n_samples, n_atoms**2)
+        :return: numpy array of shape (n_samples, n_atoms**2), or scipy.sparse.csr_matrix if a cut off was given
         """
         return self.coulMatrix
 
@@ -82,6 +97,77 @@ class CoulombMatrix():
             self.coulMatrix[sampleCount, :] = indivCM.flatten()
             sampleCount += 1
 
+    def __generateSparseCM(self, r_cut, skin):
+        """
+        This function generates the standard Coulomb Matrix descriptor where only the diagonal elements and the elements
+        of the pairs of atoms closer than r_cut are stored. The neighbour list is reused between consecutive samples
+        when the atoms have moved less than skin/2.
+
+        :r_cut: float
+        :skin: float
+        :return: scipy.sparse.csr_matrix of shape (n_samples, n_atoms^2)
+        """
+        neigh_list = NeighbourList.NeighbourList(r_cut, skin=skin)
+        rows, cols, values = [], [], []
+
+        for sampleCount, (labels, coord) in enumerate(NeighbourList.frames(self.rawX)):
+            Z = np.array([self.Z[label] for label in labels])
+            idx_i, idx_j, dist = neigh_list.update(coord)
+            diag = np.arange(self.n_atoms)
+            off_diag = Z[idx_i] * Z[idx_j] / dist
+
+            cols.extend([diag * self.n_atoms + diag, idx_i * self.n_atoms + idx_j, idx_j * self.n_atoms + idx_i])
+            values.extend([0.5 * Z ** 2.4, off_diag, off_diag])
+            rows.append(np.full(self.n_atoms + 2 * len(dist), sampleCount, dtype=np.intp))
+
+        values = np.concatenate(values).astype(self.dtype)
+
+        return sparse.csr_matrix((values, (np.concatenate(rows), np.concatenate(cols))),
+                                 shape=(self.n_samples, self.n_atoms**2))
+
+    def __sampleCM(self, i):
+        """
+        This function returns the standard Coulomb matrix of one sample as a square matrix.
+
+        :i: index of the sample
+        :return: numpy array of shape (n_atoms, n_atoms)
+        """
+        if sparse.issparse(self.coulMatrix):
+            return np.reshape(self.coulMatrix[i, :].toarray(), (self.n_atoms, self.n_atoms))
+
+        return np.reshape(self.coulMatrix[i, :], (self.n_atoms, self.n_atoms))
+
+    def tf_descriptor(self, coord, trimmed=False):
+        """
+        This function builds the standard Coulomb matrix as a TensorFlow graph, so that it can be differentiated with
+        respect to the coordinates of the atoms (for example to calculate the forces with MLPRegFlow.predict_forces).
+        The atom labels are taken from the first sample. TensorFlow is only imported when this function is called.
+
+        :coord: tf.Tensor of shape (n_samples, n_atoms, 3)
+        :trimmed: bool, default False - if True only the triangular part is returned, as in generateTrimmedCM()
+        :return: tf.Tensor of shape (n_samples, n_atoms^2) or (n_samples, n_atoms*(n_atoms+1)/2)
+        """
+        import tensorflow as tf
+
+        Z = np.array([self.Z[label] for label in self.rawX[0][0::4]])
+        eye = np.eye(self.n_atoms)
+
+        # The identity is added to the squared distances so that the gradient of the distance of an atom from itself
+        # is finite. The diagonal is then replaced by the constant diagonal elements.
+        R = tf.sqrt(tf.reduce_sum((coord[:, :, tf.newaxis, :] - coord[:, tf.newaxis, :, :]) ** 2, axis=-1) +
+                    tf.constant(eye, dtype=coord.dtype))
+        off_diag = tf.constant(np.outer(Z, Z) * (1.0 - eye), dtype=coord.dtype) / R
+        if self.r_cut is not None:
+            off_diag = off_diag * tf.cast(R < self.r_cut, coord.dtype)
+        cm = off_diag + tf.constant(np.diag(0.5 * Z ** 2.4), dtype=coord.dtype)
+
+        cm = tf.reshape(cm, [-1, self.n_atoms * self.n_atoms])
+        if trimmed:
+            rows, cols = np.triu_indices(self.n_atoms)
+            cm = tf.gather(cm, rows * self.n_atoms + cols, axis=1)
+
+        return cm
+
     def generateES(self):
         """
         This function calculates the eigen spectrum from the standard Coulomb matrix.
@@ -89,10 +175,10 @@ class CoulombMatrix():
         :return: numpy array of shape (n_samples, n_atoms)
         """
 
-        self.coulES = np.zeros((self.n_samples, self.n_atoms))
+        self.coulES = np.zeros((self.n_samples, self.n_atoms), dtype=self.dtype)
 
         for i in range(self.n_samples):
-            tempCM = np.reshape(self.coulMatrix[i, :], (self.n_atoms, self.n_atoms))
+            tempCM = self.__sampleCM(i)
             tempES, tempDiag = LA.eig(tempCM)
             self.coulES[i,:] = tempES
 
@@ -106,10 +192,10 @@ class CoulombMatrix():
         :return: numpy array of size (N_samples, n_atoms*(n_atoms+1)/2)
         """
 
-        coulS = np.zeros((self.n_samples, int(self.n_atoms * (self.n_atoms+1) * 0.5)))
+        coulS = np.zeros((self.n_samples, int(self.n_atoms * (self.n_atoms+1) * 0.5)), dtype=self.dtype)
 
         for i in range(self.n_samples):
-            tempCM = np.reshape(self.coulMatrix[i, :], (self.n_atoms, self.n_atoms))
+            tempCM = self.__sampleCM(i)
 
             # Sorting the Coulomb matrix rows and columns in descending order of the norm of each row.
             rowNorms = np.zeros(self.n_atoms)
@@ -143,11 +229,11 @@ class CoulombMatrix():
             print "Error: you cannot generate less than 1 RSCM per sample. Enter an integer value > 1."
 
         counter = 0
-        coulRS = np.zeros((self.n_samples*numRep, int(self.n_atoms * (self.n_atoms+1) * 0.5)))
+        coulRS = np.zeros((self.n_samples*numRep, int(self.n_atoms * (self.n_atoms+1) * 0.5)), dtype=self.dtype)
         y_bigdata = np.zeros((self.n_samples*numRep,))
 
         for i in range(self.n_samples):
-            tempCM = np.reshape(self.coulMatrix[i, :], (self.n_atoms, self.n_atoms))
+            tempCM = self.__sampleCM(i)
 
             # Calculating the norm vector for the coulomb matrix
             rowNorms = np.zeros(self.n_atoms)
@@ -174,17 +260,50 @@ class CoulombMatrix():
 
         return coulRS, y_bigdata
 
-    def generateTrimmedCM(self):
+    def generatePermutedCM(self, n_perm=20, kind='PRCM', chunk_size=1000, random_state=None, scaler=None):
+        """
+        This function generates n_perm randomly permuted and trimmed Coulomb matrices for each sample, in chunks of
+        chunk_size samples, so that the predictions of a model trained on randomly sorted or partially randomised
+        Coulomb matrices can be averaged over the permutations (see MLPRegFlow.predict_average) without storing all the
+        permuted matrices at once.
+
+        :n_perm: int, default 20 - number of permutations per sample
+        :kind: string, 'PRCM' or 'RSCM' - the partially randomised or the randomly sorted Coulomb matrix
+        :chunk_size: int, default 1000 - number of samples in each chunk
+        :random_state: int, np.random.RandomState or None, default None
+        :scaler: Scaling.StreamingScaler or None, default None - if given, it is updated with each chunk
+        :return: generator of numpy arrays of shape (n_samples_in_chunk*n_perm, n_atoms*(n_atoms+1)/2), where the n_perm
+            permutations of each sample are in consecutive rows
+        """
+        random_state = check_random_state(random_state)
+
+        for start in range(0, self.n_samples, chunk_size):
+            cm = self.coulMatrix[start:start + chunk_size]
+            if sparse.issparse(cm):
+                cm = cm.toarray()
+            permuted = permuted_trimmed_cm(cm, self.n_atoms, n_perm, kind=kind, random_state=random_state)
+            if scaler is not None:
+                scaler.partial_fit(permuted)
+            yield permuted
+
+    def generateTrimmedCM(self, scaler=None, chunk_size=1000):
         """
         This function returns the flattened triangular part of the original Coulomb matrix for each sample in the data.
 
+        :scaler: Scaling.StreamingScaler or None, default None - if given, it is updated with each chunk of chunk_size
+            samples as soon as it has been generated
+        :chunk_size: int, default 1000
         :return: numpy array of shape (n_samples, n_atoms * (n_atoms+1)/2 )
         """
-        self.trimCM = np.zeros((self.n_samples, int(self.n_atoms * (self.n_atoms+1) * 0.5)))
+        self.trimCM = np.zeros((self.n_samples, int(self.n_atoms * (self.n_atoms+1) * 0.5)), dtype=self.dtype)
 
-        for i in range(self.n_samples):
-            tempCM = np.reshape(self.coulMatrix[i,:], (self.n_atoms, self.n_atoms))
-            self.trimCM[i,:] = self.trimAndFlat(tempCM)
+        for start in range(0, self.n_samples, chunk_size):
+            end = min(start + chunk_size, self.n_samples)
+            for i in range(start, end):
+                tempCM = self.__sampleCM(i)
+                self.trimCM[i,:] = self.trimAndFlat(tempCM)
+            if scaler is not None:
+                scaler.partial_fit(self.trimCM[start:end])
 
         return self.trimCM
 
@@ -196,7 +315,7 @@ class CoulombMatrix():
         :return: numpy array of shape (n_atoms*(n_atoms+1)/2, )
         """
         size = int(self.n_atoms * (self.n_atoms+1) * 0.5)
-        temp = np.zeros((size,))
+        temp = np.zeros((size,), dtype=self.dtype)
         counter = 0
 
         for i in range(self.n_atoms):
@@ -219,8 +338,7 @@ class CoulombMatrix():
         PRCM = []
 
         for j in range(self.n_samples):
-            flatMat = self.coulMatrix[j, :]
-            currentMat = np.reshape(flatMat, (self.n_atoms, self.n_atoms))
+            currentMat = self.__sampleCM(j)
 
             # Check if there are two elements that are the same (check elements along diagonal)
             diag = currentMat.diagonal()
@@ -262,7 +380,7 @@ class CoulombMatrix():
                 PRCM.append(self.trimAndFlat(currentMat))
 
         # Turn PRCM into a numpy array of size (n_samples*min(n_perm, numRep), n_features)
-        PRCM = np.asarray(PRCM)
+        PRCM = np.asarray(PRCM, dtype=self.dtype)
 
         # Modify the shape of y
         y_big = np.asarray(np.repeat(y_data,min(n_perm, numRep)))
@@ -311,6 +429,47 @@ class CoulombMatrix():
         sns.plt.show()
 
 
+def permuted_trimmed_cm(cm, n_atoms, n_perm, kind='PRCM', random_state=None):
+    """
+    This function generates n_perm random permutations of each Coulomb matrix in cm and returns their triangular part.
+    All the permutations of all the samples are generated at once with numpy, without loops over the samples.
+
+    With kind='PRCM', the rows/columns are sorted by increasing diagonal element and the atoms with the same diagonal
+    element are shuffled, as in CoulombMatrix.generatePRCM. With kind='RSCM', they are sorted by decreasing norm of the
+    rows after adding gaussian noise to the norms, as in CoulombMatrix.generateRSCM.
+
+    :cm: numpy array of shape (n_samples, n_atoms^2) - the standard Coulomb matrices
+    :n_atoms: int
+    :n_perm: int - number of permutations per sample
+    :kind: string, 'PRCM' or 'RSCM'
+    :random_state: int, np.random.RandomState or None
+    :return: numpy array of shape (n_samples*n_perm, n_atoms*(n_atoms+1)/2), where the n_perm permutations of each
+        sample are in consecutive rows
+    """
+    random_state = check_random_state(random_state)
+    cm = np.reshape(cm, (-1, n_atoms, n_atoms))
+    n_samples = cm.shape[0]
+    noise = random_state.uniform(size=(n_samples, n_perm, n_atoms))
+
+    if kind == 'PRCM':
+        # Sorting by diagonal element, with the random numbers breaking the ties between identical atoms
+        diag = np.broadcast_to(np.diagonal(cm, axis1=1, axis2=2)[:, np.newaxis, :], noise.shape)
+        perm = np.lexsort((noise, diag), axis=-1)
+    elif kind == 'RSCM':
+        row_norms = np.linalg.norm(cm, axis=2)
+        scale = np.std(row_norms, axis=1)[:, np.newaxis, np.newaxis]
+        noisy_norms = row_norms[:, np.newaxis, :] + scale * random_state.normal(size=noise.shape)
+        perm = np.argsort(-noisy_norms, axis=-1)
+    else:
+        raise ValueError("The kind of permutation should be 'PRCM' or 'RSCM', got %s." % kind)
+
+    # Element (i, j) of the triangular part of each permuted matrix is element (perm[i], perm[j]) of the original one
+    rows, cols = np.triu_indices(n_atoms)
+    sample_idx = np.arange(n_samples)[:, np.newaxis, np.newaxis]
+    trimmed = cm[sample_idx, perm[:, :, rows], perm[:, :, cols]]
+
+    return np.reshape(trimmed, (n_samples * n_perm, rows.shape[0]))
+
 
 if __name__ == "__main__":
 
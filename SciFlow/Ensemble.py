@@ -0,0 +1,172 @@
+"""
+This module trains an ensemble of MLPRegFlow neural networks that only differ in the random seed, so that the spread of
+their predictions can be used as an estimate of the uncertainty of the prediction.
+
+The members of the ensemble are trained at the same time in a pool of processes. The training data is written once to
+.npy files and each process opens them as read-only numpy memmaps, so that all the processes share the same copy of
+the data in memory (through the page cache of the operating system) instead of each having its own.
+
+Since the processes are started with the 'spawn' method (when available), a script that uses this module should call
+fit from within an ``if __name__ == "__main__":`` block.
+"""
+
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin, clone
+from sklearn.utils import check_random_state
+from sklearn.utils.validation import check_X_y
+from sklearn.metrics import r2_score
+import NNFlow
+
+
+def _fit_member(args):
+    """
+    This function trains one member of the ensemble. It runs in a worker process, so it is a module level function.
+
+    :args: tuple with the estimator to train, the random seed and the paths of the .npy files with X and y
+    :return: the trained estimator
+    """
+    estimator, seed, X_path, y_path = args
+
+    X = np.load(X_path, mmap_mode='r')
+    y = np.load(y_path, mmap_mode='r')
+
+    estimator.set_params(random_state=seed)
+    estimator.fit(X, y)
+
+    return estimator
+
+
+class MLPEnsemble(BaseEstimator, ClassifierMixin):
+    """
+    Ensemble of MLPRegFlow estimators trained on the same data with different random seeds.
+
+    :base_estimator: MLPRegFlow or None, default None
+
+        Estimator that is cloned to make each member of the ensemble. If None, MLPRegFlow() is used.
+
+    :n_estimators: int, default 10
+
+        Number of members of the ensemble.
+
+    :n_jobs: int or None, default None
+
+        Number of members trained at the same time. If None, the number of CPUs is used.
+
+    :threads_per_member: int or None, default None
+
+        Number of threads used by TensorFlow in each member (it sets intra_op_threads of the members). When n_jobs
+        members are trained at the same time, n_jobs * threads_per_member should not be larger than the number of
+        cores. If None, the threads of base_estimator are used.
+
+    :random_state: int or None, default None
+
+        Seed used to generate the seeds of the members.
+
+    :tmp_dir: string or None, default None
+
+        Directory where the training data is written so that it can be shared by the processes. If None, the default
+        temporary directory is used.
+
+    """
+
+    def __init__(self, base_estimator=None, n_estimators=10, n_jobs=None, threads_per_member=None, random_state=None,
+                 tmp_dir=None):
+
+        self.base_estimator = base_estimator
+        self.n_estimators = n_estimators
+        self.n_jobs = n_jobs
+        self.threads_per_member = threads_per_member
+        self.random_state = random_state
+        self.tmp_dir = tmp_dir
+
+    def fit(self, X, y):
+        """
+        Fit all the members of the ensemble to data matrix X and target y.
+
+        :X: array of shape (n_samples, n_features)
+        :y: array of shape (n_samples,) or (n_samples, n_output)
+        """
+        X, y = check_X_y(X, y, multi_output=True)
+
+        base_estimator = self.base_estimator if self.base_estimator is not None else NNFlow.MLPRegFlow()
+        if self.threads_per_member is not None:
+            base_estimator = clone(base_estimator).set_params(intra_op_threads=self.threads_per_member,
+                                                             inter_op_threads=1)
+        seeds = check_random_state(self.random_state).randint(np.iinfo(np.int32).max, size=self.n_estimators)
+        n_jobs = self.n_jobs if self.n_jobs is not None else multiprocessing.cpu_count()
+
+        data_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        try:
+            X_path = os.path.join(data_dir, 'X.npy')
+            y_path = os.path.join(data_dir, 'y.npy')
+            np.save(X_path, X)
+            np.save(y_path, y)
+
+            jobs = [(clone(base_estimator), int(seed), X_path, y_path) for seed in seeds]
+
+            if n_jobs > 1:
+                pool = self.__pool(min(n_jobs, self.n_estimators))
+                try:
+                    self.estimators_ = pool.map(_fit_member, jobs, chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                self.estimators_ = [_fit_member(job) for job in jobs]
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+        return self
+
+    def __pool(self, n_processes):
+        """
+        This function makes the pool of processes used to train the members. The processes are started with the
+        'spawn' method when it is available, since a process forked from one where TensorFlow is already running can
+        hang.
+
+        :n_processes: int
+        :return: multiprocessing.Pool
+        """
+        if hasattr(multiprocessing, 'get_context'):
+            return multiprocessing.get_context('spawn').Pool(n_processes)
+
+        return multiprocessing.Pool(n_processes)
+
+    def predict(self, X, return_std=False):
+        """
+        This function returns the mean of the predictions of the members of the ensemble and optionally their standard
+        deviation.
+
+        :X: array of shape (n_samples, n_features)
+        :return_std: bool, default False - whether to also return the standard deviation of the predictions
+        :return: array of shape (n_samples, n_output) with the mean of the predictions and, if return_std is True, array
+            of shape (n_samples, n_output) with their standard deviation
+        """
+        if not hasattr(self, 'estimators_'):
+            raise AttributeError("The fit function has not been called yet, so the ensemble has not been trained yet.")
+
+        predictions = np.array([estimator.predict(X) for estimator in self.estimators_])
+        mean = np.mean(predictions, axis=0)
+
+        if return_std:
+            return mean, np.std(predictions, axis=0)
+
+        return mean
+
+    def score(self, X, y, sample_weight=None):
+        """
+        Returns the R^2 value of the mean prediction of the ensemble.
+
+        :X: array of shape (n_samples, n_features)
+        :y: array of shape (n_samples, n_output)
+        :sample_weight: array of shape (n_samples,)
+        :return: double
+        """
+        y_pred = self.predict(X)
+
+        return r2_score(y, y_pred, sample_weight=sample_weight)
@@ -0,0 +1,228 @@
+"""
+This module exports trained MLPRegFlow and BPNN estimators as TensorFlow graphs that can be loaded by another process
+(for example a molecular dynamics code) without SciFlow and without rebuilding the network from all_weights.
+
+The exported graph has the weights as constants and fixed input signatures:
+
+1. 'features': tf.float32 of shape (None, n_features) - the descriptor. The output 'energy' has shape (None, n_output).
+2. 'coord': tf.float32 of shape (None, n_atoms, 3) - only if a descriptor function is given. The descriptor is then
+   calculated inside the graph, and the outputs are 'coord_energy' with shape (None, n_output) and 'forces' with shape
+   (None, n_atoms, 3).
+
+Two formats are available: a SavedModel with the signatures 'serving_default' (from the features) and 'energy_forces'
+(from the coordinates), or a frozen GraphDef (frozen_graph.pb) where the tensors have the names above (for example
+'features:0' and 'energy:0').
+
+The function benchmark compares the time taken by the exported model to make predictions with the time taken by the
+predict function of the estimator.
+"""
+
+from __future__ import print_function
+import os
+import timeit
+import numpy as np
+import tensorflow as tf
+
+FROZEN_GRAPH = 'frozen_graph.pb'
+
+# Names of the input and output tensors in the exported graph
+_FEATURE_TENSORS = {'inputs': {'features': 'features:0'}, 'outputs': {'energy': 'energy:0'}}
+_COORD_TENSORS = {'inputs': {'coord': 'coord:0'}, 'outputs': {'energy': 'coord_energy:0', 'forces': 'forces:0'}}
+
+
+def _build_graph(estimator, n_feat, descriptor, n_atoms):
+    """
+    This function builds the inference graph of the estimator with the weights as constants.
+
+    :estimator: MLPRegFlow or BPNN object that has already been fitted
+    :n_feat: int - number of features of the descriptor
+    :descriptor: function that takes a tf.Tensor of coordinates of shape (n_samples, n_atoms, 3) and returns the
+        descriptor as a tf.Tensor of shape (n_samples, n_features), or None
+    :n_atoms: int or None
+    :return: the tf.Graph and a dictionary with the input and output tensors
+    """
+    graph = tf.Graph()
+    tensors = {}
+
+    with graph.as_default():
+        features = tf.placeholder(tf.float32, [None, n_feat], name='features')
+        tensors['features'] = features
+        tensors['energy'] = tf.identity(estimator.inference_graph(features), name='energy')
+
+        if descriptor is not None:
+            coord = tf.placeholder(tf.float32, [None, n_atoms, 3], name='coord')
+            energy, forces = estimator.forces_graph(coord, descriptor)
+            energy = tf.identity(energy, name='coord_energy')
+            forces = tf.identity(forces, name='forces')
+            tensors.update({'coord': coord, 'coord_energy': energy, 'forces': forces})
+
+    return graph, tensors
+
+
+def export_model(estimator, path, n_feat, descriptor=None, n_atoms=None, kind='saved_model'):
+    """
+    This function exports a trained estimator to the directory path, which must not exist yet.
+
+    :estimator: MLPRegFlow or BPNN object that has already been fitted
+    :path: string
+    :n_feat: int - number of features of the descriptor
+    :descriptor: function or None, default None - function that takes a tf.Tensor of coordinates of shape
+        (n_samples, n_atoms, 3) and returns the descriptor, for example the function tf_descriptor of a CoulombMatrix
+        or SymmetryFunctions object. If given, the graph also calculates the energies and the forces from the
+        coordinates.
+    :n_atoms: int or None, default None - number of atoms, needed if descriptor is given
+    :kind: string, 'saved_model' or 'frozen_graph', default 'saved_model'
+    """
+    if kind not in ('saved_model', 'frozen_graph'):
+        raise ValueError("The kind should be 'saved_model' or 'frozen_graph', got %s." % kind)
+    if descriptor is not None and n_atoms is None:
+        raise ValueError("The number of atoms is needed to export the descriptor.")
+
+    graph, tensors = _build_graph(estimator, n_feat, descriptor, n_atoms)
+
+    if kind == 'frozen_graph':
+        # All the weights are constants, so the graph is already frozen
+        os.makedirs(path)
+        tf.train.write_graph(graph.as_graph_def(), path, FROZEN_GRAPH, as_text=False)
+        return
+
+    signatures = {'serving_default': tf.saved_model.signature_def_utils.predict_signature_def(
+        inputs={'features': tensors['features']}, outputs={'energy': tensors['energy']})}
+    if descriptor is not None:
+        signatures['energy_forces'] = tf.saved_model.signature_def_utils.predict_signature_def(
+            inputs={'coord': tensors['coord']},
+            outputs={'energy': tensors['coord_energy'], 'forces': tensors['forces']})
+
+    builder = tf.saved_model.builder.SavedModelBuilder(path)
+    with tf.Session(graph=graph) as sess:
+        builder.add_meta_graph_and_variables(sess, [tf.saved_model.tag_constants.SERVING],
+                                             signature_def_map=signatures)
+    builder.save()
+
+
+class ExportedModel():
+    """
+    This class loads a model written by export_model (in either format) and makes predictions with it. The session is
+    opened once and kept open.
+
+    :path: string - directory of the exported model
+    :intra_op_threads: int, default 0 - number of threads used by TensorFlow to run a single operation (0 for all the
+        cores)
+    :inter_op_threads: int, default 0
+    """
+
+    def __init__(self, path, intra_op_threads=0, inter_op_threads=0):
+
+        self.path = path
+        config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                                inter_op_parallelism_threads=inter_op_threads)
+        graph = tf.Graph()
+        self.session = tf.Session(graph=graph, config=config)
+
+        with graph.as_default():
+            if os.path.exists(os.path.join(path, FROZEN_GRAPH)):
+                graph_def = tf.GraphDef()
+                with open(os.path.join(path, FROZEN_GRAPH), 'rb') as pb_file:
+                    graph_def.ParseFromString(pb_file.read())
+                tf.import_graph_def(graph_def, name='')
+                signatures = {'serving_default': _FEATURE_TENSORS}
+                if 'coord' in [op.name for op in graph.get_operations()]:
+                    signatures['energy_forces'] = _COORD_TENSORS
+            else:
+                meta_graph = tf.saved_model.loader.load(self.session, [tf.saved_model.tag_constants.SERVING], path)
+                signatures = {}
+                for key, signature in meta_graph.signature_def.items():
+                    signatures[key] = {'inputs': dict((name, info.name) for name, info in signature.inputs.items()),
+                                       'outputs': dict((name, info.name) for name, info in signature.outputs.items())}
+
+        self.signatures = {}
+        for key, signature in signatures.items():
+            self.signatures[key] = {
+                'inputs': dict((name, graph.get_tensor_by_name(tensor)) for name, tensor in signature['inputs'].items()),
+                'outputs': dict((name, graph.get_tensor_by_name(tensor)) for name, tensor in signature['outputs'].items())}
+
+    def predict(self, X):
+        """
+        This function returns the predictions for the descriptors in X.
+
+        :X: array of shape (n_samples, n_features)
+        :return: array of shape (n_samples, n_output)
+        """
+        signature = self.signatures['serving_default']
+
+        return self.session.run(signature['outputs']['energy'],
+                                feed_dict={signature['inputs']['features']: np.asarray(X, dtype=np.float32)})
+
+    def predict_forces(self, coord):
+        """
+        This function returns the energies and the forces for the configurations in coord. It can only be used if the
+        descriptor was exported with the model.
+
+        :coord: array of shape (n_samples, n_atoms, 3)
+        :return: array of shape (n_samples, n_output) with the energies and array of shape (n_samples, n_atoms, 3) with
+            the forces
+        """
+        if 'energy_forces' not in self.signatures:
+            raise ValueError("The model was exported without the descriptor, so the forces can't be calculated.")
+
+        signature = self.signatures['energy_forces']
+
+        return self.session.run([signature['outputs']['energy'], signature['outputs']['forces']],
+                                feed_dict={signature['inputs']['coord']: np.asarray(coord, dtype=np.float32)})
+
+    def close(self):
+        """
+        This function closes the session.
+        """
+        self.session.close()
+
+
+def _median_time(function, n_repeat):
+    """
+    This function calls function n_repeat times and returns the median of the times taken.
+
+    :function: function without arguments
+    :n_repeat: int
+    :return: float - time in seconds
+    """
+    times = []
+    for ii in range(n_repeat):
+        start = timeit.default_timer()
+        function()
+        times.append(timeit.default_timer() - start)
+
+    return float(np.median(times))
+
+
+def benchmark(estimator, path, X, batch_sizes=(1, 100, 10000), n_repeat=20):
+    """
+    This function measures the latency of the exported model and of the predict function of the estimator for batches
+    of different sizes. Each call is repeated n_repeat times (after one call to warm up) and the median is kept.
+
+    :estimator: MLPRegFlow or BPNN object that was exported to path
+    :path: string - directory of the exported model
+    :X: array of shape (n_samples, n_features) - the batches are taken from the first samples of X
+    :batch_sizes: tuple of int, default (1, 100, 10000)
+    :n_repeat: int, default 20
+    :return: list of dictionaries with the batch size ('batch_size'), the median time of predict ('predict') and of
+        the exported model ('exported') in seconds, and the ratio between the two ('speed_up')
+    """
+    exported = ExportedModel(path)
+    results = []
+
+    try:
+        for batch_size in batch_sizes:
+            X_batch = np.asarray(X[:batch_size])
+            exported.predict(X_batch)
+            estimator.predict(X_batch)
+
+            time_exported = _median_time(lambda: exported.predict(X_batch), n_repeat)
+            time_predict = _median_time(lambda: estimator.predict(X_batch), n_repeat)
+            results.append({'batch_size': X_batch.shape[0], 'predict': time_predict, 'exported': time_exported,
+                            'speed_up': time_predict / time_exported})
+            print("Batch size %d: predict %.3g s, exported model %.3g s" % (X_batch.shape[0], time_predict,
+                                                                            time_exported))
+    finally:
+        exported.close()
+
+    return results
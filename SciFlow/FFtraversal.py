@@ -9,7 +9,6 @@ import CoulombMatrix
 import cProfile, pstats, StringIO
 import time
 from datetime import datetime
-import matplotlib.pyplot as plt
 
 def fft_idx(X, k):
     """
@@ -86,6 +85,7 @@ if __name__ == "__main__":
     #     finalTime = endTime - startTime
     #     y.append(finalTime)
     #
+    # import matplotlib.pyplot as plt
     # fig2, ax2 = plt.subplots(figsize=(6, 6))
     # ax2.scatter(x, y)
     # ax2.set_xlabel('Data set size')
@@ -0,0 +1,312 @@
+"""
+This module searches the hyperparameters of an MLPRegFlow estimator without going through Osprey. The data is loaded
+and featurised only once: it is split into a training and a validation set, which are written to .npy files and opened
+as read-only numpy memmaps by each process of a pool of workers, so that all the workers share the same copy of the data
+in memory. The workers are started once and import TensorFlow once, and then run many trials each.
+
+Three kinds of search are available:
+
+1. 'random': n_iter sets of hyperparameters are sampled from param_distributions.
+2. 'grid': all the combinations of the values in param_distributions are tried.
+3. 'halving': successive halving. n_iter random sets of hyperparameters are trained for min_iter iterations, the best
+   1/eta of them are trained for eta times more iterations and so on until max_iter is reached.
+
+With 'random' and 'grid', the trials that are clearly losing can be pruned: each trial is trained in n_steps steps and
+after each step its validation error is compared to the errors of the other trials after the same number of steps. If
+it is worse than the prune_quantile quantile of them, the trial is stopped.
+
+Since the processes are started with the 'spawn' method (when available), a script that uses this module should call
+fit from within an ``if __name__ == "__main__":`` block.
+"""
+
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import multiprocessing
+import numpy as np
+from sklearn.base import clone
+from sklearn.model_selection import ParameterGrid, ParameterSampler
+from sklearn.utils import check_random_state
+from sklearn.utils.validation import check_X_y
+
+# Validation errors reported by all the trials after each step and lock protecting them. They are shared by the
+# workers and set by _init_worker, together with the number of threads that each worker can use.
+_records = None
+_lock = None
+_n_threads = None
+
+
+# Environment variables that set the number of threads of the libraries that do the linear algebra
+_THREAD_VARIABLES = ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS')
+
+
+def _init_worker(records, lock, n_threads):
+    """
+    This function is run once in each worker when it is started. It stores the shared objects and the number of threads
+    that TensorFlow can use, so that the workers don't compete for the cores.
+
+    :records: dictionary shared between the processes, where the validation errors are reported
+    :lock: lock shared between the processes
+    :n_threads: int or None
+    """
+    global _records, _lock, _n_threads
+    _records = records
+    _lock = lock
+    _n_threads = n_threads
+
+
+def _run_trial(args):
+    """
+    This function trains one estimator with a set of hyperparameters and returns its validation error. It runs in a
+    worker process, so it is a module level function.
+
+    :args: tuple with the estimator, the hyperparameters, the number of iterations, the number of steps in which the
+        training is split, the paths of the .npy files with the data and the pruning settings
+    :return: dictionary with the results of the trial
+    """
+    estimator, params, n_iter, n_steps, paths, prune_quantile, min_trials = args
+    X, y, X_val, y_val = [np.load(path, mmap_mode='r') for path in paths]
+
+    estimator = clone(estimator)
+    estimator.set_params(**params)
+    if _n_threads is not None:
+        estimator.set_params(intra_op_threads=_n_threads, inter_op_threads=1)
+
+    # Each step continues the training of the previous one. The iterations are split so that they add up to n_iter.
+    n_steps = max(1, min(n_steps, n_iter))
+    step_iters = [n_iter // n_steps + (1 if step < n_iter % n_steps else 0) for step in range(n_steps)]
+    estimator.set_params(warm_start=n_steps > 1)
+
+    result = {'params': params, 'n_iter': 0, 'val_rmse': np.inf, 'pruned': False}
+
+    for step in range(n_steps):
+        estimator.set_params(max_iter=step_iters[step])
+        estimator.fit(X, y)
+        y_pred = estimator.predict(X_val)
+        rmse = float(np.sqrt(np.mean((np.reshape(y_pred, np.shape(y_val)) - y_val) ** 2)))
+        # A trial that has diverged is the worst possible one. NaN would compare as neither better nor worse than the
+        # other errors, so it is replaced by infinity.
+        if not np.isfinite(rmse):
+            rmse = np.inf
+        result['n_iter'] += step_iters[step]
+        result['val_rmse'] = rmse
+
+        if prune_quantile is None or _records is None:
+            continue
+
+        with _lock:
+            previous = _records.get(step, [])
+            _records[step] = previous + [rmse]
+
+        # The weights of a trial that has diverged don't recover, so it is pruned straight away
+        if rmse == np.inf:
+            result['pruned'] = True
+            break
+
+        # The quantile is taken as one of the errors (without interpolating), so that it is not NaN when some of the
+        # errors are infinite
+        if len(previous) >= min_trials and rmse > np.sort(previous)[int(prune_quantile * (len(previous) - 1))]:
+            result['pruned'] = True
+            break
+
+    return result
+
+
+class HyperSearch():
+    """
+    This class searches the hyperparameters of an MLPRegFlow estimator with a pool of worker processes. The score of
+    each set of hyperparameters is the root mean square error on a validation set (lower is better).
+
+    :estimator: MLPRegFlow - estimator whose hyperparameters are searched. The parameters that are not searched are
+        taken from it.
+    :param_distributions: dictionary where the keys are the names of the parameters and the values are lists of values
+        or (for 'random' and 'halving') scipy.stats distributions. max_iter can't be searched: the max_iter of estimator
+        is the number of iterations of the complete trials.
+    :search: string, 'random', 'grid' or 'halving', default 'random'
+    :n_iter: int, default 20 - number of sets of hyperparameters sampled for 'random' and 'halving'
+    :n_jobs: int or None, default None - number of worker processes. If None, the number of CPUs is used.
+    :threads_per_worker: int or None, default 1 - maximum number of threads used by each worker
+    :validation_fraction: float, default 0.2 - fraction of the data used as validation set
+    :prune: bool, default True - whether to prune the losing trials with 'random' and 'grid'
+    :n_steps: int, default 4 - number of steps in which each trial is split when pruning
+    :prune_quantile: float, default 0.5 - a trial is pruned if its error is worse than this quantile of the errors of
+        the other trials after the same number of steps
+    :min_trials: int, default 3 - number of trials that need to have reported an error before pruning starts
+    :min_iter: int, default 10 - number of iterations of the first round of 'halving'
+    :eta: int, default 3 - fraction of the trials kept after each round of 'halving'
+    :refit: bool, default True - whether to train the best estimator on all the data at the end
+    :random_state: int or None, default None
+    :tmp_dir: string or None, default None - directory where the shared data is written
+    """
+
+    def __init__(self, estimator, param_distributions, search='random', n_iter=20, n_jobs=None, threads_per_worker=1,
+                 validation_fraction=0.2, prune=True, n_steps=4, prune_quantile=0.5, min_trials=3, min_iter=10, eta=3,
+                 refit=True, random_state=None, tmp_dir=None):
+
+        if search not in ('random', 'grid', 'halving'):
+            raise ValueError("The search should be 'random', 'grid' or 'halving', got %s." % search)
+        # The number of iterations of each trial is set by the search (the max_iter of estimator is the budget)
+        if 'max_iter' in param_distributions:
+            raise ValueError("max_iter can't be searched, set it in the estimator instead.")
+
+        self.estimator = estimator
+        self.param_distributions = param_distributions
+        self.search = search
+        self.n_iter = n_iter
+        self.n_jobs = n_jobs
+        self.threads_per_worker = threads_per_worker
+        self.validation_fraction = validation_fraction
+        self.prune = prune
+        self.n_steps = n_steps
+        self.prune_quantile = prune_quantile
+        self.min_trials = min_trials
+        self.min_iter = min_iter
+        self.eta = eta
+        self.refit = refit
+        self.random_state = random_state
+        self.tmp_dir = tmp_dir
+
+    def fit(self, X, y):
+        """
+        This function runs the search. The results of all the trials are stored in results_, the best hyperparameters in
+        best_params_ and their validation error in best_score_. If refit is True, the estimator trained on all the data
+        with the best hyperparameters is stored in best_estimator_.
+
+        :X: array of shape (n_samples, n_features) - the featurised data
+        :y: array of shape (n_samples,) or (n_samples, n_output)
+        :return: self
+        """
+        X, y = check_X_y(X, y, multi_output=True)
+        random_state = check_random_state(self.random_state)
+
+        if self.search == 'grid':
+            candidates = list(ParameterGrid(self.param_distributions))
+        else:
+            candidates = list(ParameterSampler(self.param_distributions, self.n_iter, random_state=random_state))
+
+        n_jobs = self.n_jobs if self.n_jobs is not None else multiprocessing.cpu_count()
+
+        data_dir = tempfile.mkdtemp(dir=self.tmp_dir)
+        manager = multiprocessing.Manager()
+        pool = self.__pool(n_jobs, manager)
+        try:
+            paths = self.__write_data(X, y, data_dir, random_state)
+
+            if self.search == 'halving':
+                self.results_ = self.__successive_halving(pool, candidates, paths)
+            else:
+                n_steps = self.n_steps if self.prune else 1
+                prune_quantile = self.prune_quantile if self.prune else None
+                jobs = [(self.estimator, params, self.estimator.max_iter, n_steps, paths, prune_quantile,
+                         self.min_trials) for params in candidates]
+                self.results_ = pool.map(_run_trial, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            manager.shutdown()
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+        # Pruned trials and trials stopped in the early rounds of halving are not candidates for the best
+        # (if all the trials have diverged and been pruned, the best of them is still returned)
+        complete = [result for result in self.results_ if not result['pruned']] or self.results_
+        best = min(complete, key=lambda result: result['val_rmse'])
+        self.best_params_ = best['params']
+        self.best_score_ = best['val_rmse']
+
+        if self.refit:
+            self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_)
+            self.best_estimator_.fit(X, y)
+
+        return self
+
+    def __pool(self, n_processes, manager):
+        """
+        This function starts the worker processes. They are started with the 'spawn' method when it is available, since
+        a process forked from one where TensorFlow is already running can hang.
+
+        :n_processes: int
+        :manager: multiprocessing.Manager used to share the validation errors between the workers
+        :return: multiprocessing.Pool
+        """
+        initargs = (manager.dict(), manager.Lock(), self.threads_per_worker)
+
+        # The linear algebra libraries read the number of threads when numpy is imported, which happens in the workers
+        # before _init_worker runs, so the variables are set in the environment that the workers inherit
+        saved_env = dict((var, os.environ.get(var)) for var in _THREAD_VARIABLES)
+        if self.threads_per_worker is not None:
+            for var in _THREAD_VARIABLES:
+                os.environ[var] = str(self.threads_per_worker)
+
+        try:
+            if hasattr(multiprocessing, 'get_context'):
+                return multiprocessing.get_context('spawn').Pool(n_processes, _init_worker, initargs)
+
+            return multiprocessing.Pool(n_processes, _init_worker, initargs)
+        finally:
+            for var, value in saved_env.items():
+                if value is None:
+                    os.environ.pop(var, None)
+                else:
+                    os.environ[var] = value
+
+    def __write_data(self, X, y, data_dir, random_state):
+        """
+        This function splits the data into a training and a validation set and writes them to .npy files, so that the
+        workers can open them as memmaps.
+
+        :X: array of shape (n_samples, n_features)
+        :y: array of shape (n_samples,) or (n_samples, n_output)
+        :data_dir: string
+        :random_state: np.random.RandomState
+        :return: list of the paths of the files with X, y, X_val and y_val
+        """
+        idx = random_state.permutation(X.shape[0])
+        n_val = max(1, int(self.validation_fraction * X.shape[0]))
+        idx_val, idx_train = np.sort(idx[:n_val]), np.sort(idx[n_val:])
+
+        if y.ndim == 1:
+            y = np.reshape(y, (-1, 1))
+
+        paths = []
+        for name, array in (('X', X[idx_train]), ('y', y[idx_train]), ('X_val', X[idx_val]), ('y_val', y[idx_val])):
+            paths.append(os.path.join(data_dir, name + '.npy'))
+            np.save(paths[-1], array)
+
+        return paths
+
+    def __successive_halving(self, pool, candidates, paths):
+        """
+        This function runs successive halving: all the candidates are trained with a small number of iterations and
+        only the best 1/eta of them are trained again with eta times more iterations, until max_iter is reached.
+
+        :pool: multiprocessing.Pool
+        :candidates: list of dictionaries of hyperparameters
+        :paths: list of the paths of the files with the data
+        :return: list of dictionaries with the results of the trials of all the rounds
+        """
+        results = []
+        n_iter = self.min_iter
+
+        while True:
+            # The last round always trains the survivors for exactly max_iter iterations
+            n_iter = min(n_iter, self.estimator.max_iter)
+            if len(candidates) == 1:
+                n_iter = self.estimator.max_iter
+            jobs = [(self.estimator, params, n_iter, 1, paths, None, self.min_trials) for params in candidates]
+            round_results = pool.map(_run_trial, jobs, chunksize=1)
+            round_results.sort(key=lambda result: result['val_rmse'])
+
+            n_keep = max(1, len(candidates) // self.eta)
+            last_round = n_iter >= self.estimator.max_iter or len(candidates) == 1
+
+            # The trials that don't make it to the next round count as pruned
+            for result in round_results:
+                result['pruned'] = not last_round
+            results.extend(round_results)
+
+            if last_round:
+                return results
+
+            candidates = [result['params'] for result in round_results[:n_keep]]
+            n_iter = n_iter * self.eta
@@ -252,12 +252,13 @@ def loadX(fileX):
     inputFile.close()
     return matrixX
 
-def loadY(fileY):
+def loadY(fileY, dtype=np.float64):
     """
     This function takes a .csv file containing the energies of a system and returns an array with the energies contained
     in the file.
 
     :fileY: the .csv file containing the energies of the system (string)
+    :dtype: numpy dtype of the array returned, default np.float64
     :return: numpy array of shape (n_samples, 1)
     """
 
@@ -272,12 +273,12 @@ def loadY(fileY):
     for line in inputFile:
         y_list.append(float(line))
 
-    matrixY = np.asarray(y_list).reshape((len(y_list), 1))
+    matrixY = np.asarray(y_list, dtype=dtype).reshape((len(y_list), 1))
 
     inputFile.close()
     return matrixY
 
-def loadPd(fileName):
+def loadPd(fileName, dtype=np.float64):
     """
     This function takes a .csv file generated after processing the original CSV files with the package PANDAS.
     The new csv file contains on each line a different configuration of the system in the format
@@ -291,6 +292,7 @@ def loadPd(fileName):
 
 
     :fileX: The .csv file containing the geometries and the energies at 2 levels of theory for the system
+    :dtype: numpy dtype of the energy differences, default np.float64
     :return:
     :matrixX: a list of lists with characters and floats.
     :matrixY: and a list of energy differences of size (n_samples,)
@@ -330,12 +332,12 @@ def loadPd(fileName):
                 geom[i+j+1] = float(geom[i+j+1])
         matrixX.append(geom)
 
-    matrixY = np.asarray(matrixY)
+    matrixY = np.asarray(matrixY, dtype=dtype)
     inputFile.close()
 
     return matrixX, matrixY
 
-def loadPd_q(fileName):
+def loadPd_q(fileName, dtype=np.float64):
     """
     This function takes a .csv file generated after processing the original CSV files with the package PANDAS.
     The data is arranged with first the geometries in a 'clean datases' arrangement. This means that the headers tell
@@ -350,6 +352,7 @@ def loadPd_q(fileName):
     **Note**: This is specific to the CH4CN system!
 
     :fileName: .csv file (string)
+    :dtype: numpy dtype of the energy differences and of the partial charges, default np.float64
 
     :return:
     :matrixX: a list of lists with characters and floats.
@@ -384,9 +387,9 @@ def loadPd_q(fileName):
 
         matrixX.append(geom)
         matrixY.append(eneDiff)
-        matrixQ.append(partQ)
+        matrixQ.append(partQ.astype(dtype))
 
-    matrixY = np.asarray(matrixY)
+    matrixY = np.asarray(matrixY, dtype=dtype)
 
     return matrixX, matrixY, matrixQ
 
@@ -3,16 +3,16 @@ This module implements a Tensorflow neural network as a Scikit learn estimator.
 """
 
 from __future__ import print_function
+import os
+import pickle
 import numpy as np
 from sklearn.base import BaseEstimator, ClassifierMixin
 from sklearn.utils.validation import check_X_y, check_array
 from sklearn.metrics import mean_squared_error
 from sklearn.metrics import mean_absolute_error
 import tensorflow as tf
-import matplotlib.pyplot as plt
+import TFSession
 from sklearn.metrics import r2_score
-import seaborn as sns
-import pandas as pd
 
 
 class MLPRegFlow(BaseEstimator, ClassifierMixin):
@@ -44,10 +44,90 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
 
         Total number of iterations that will be carried out during the training process.
 
+    :input_pipeline: string, default 'feed'
+
+        How the mini-batches are passed to TensorFlow during the training. With 'feed' the data is sliced in a fixed
+        order and passed with a feed_dict (the last incomplete batch is not used). With 'dataset' the data is passed
+        through a tf.data pipeline that shuffles it at every iteration, uses the last incomplete batch and prefetches
+        the next batch (on the GPU if there is one) while the current one is being used. X can also be a numpy memmap,
+        in which case the batches are read from disk as they are needed.
+
+    :random_state: int or None, default None
+
+        Seed used to initialise the weights and to shuffle the data at each iteration.
+
+    :eval_interval: int, default 50
+
+        Number of iterations between two evaluations of the model on the test set (if one is passed to fit).
+
+    :eval_batch_size: int, default 10000
+
+        Number of samples of the test set evaluated at once. It is also the default number of samples passed to the
+        network at once by predict.
+
+    :early_stopping: bool, default False
+
+        Whether to stop the training when the root mean square error on a validation set stops improving. The
+        validation set is a fraction validation_fraction of the training set that is not used for training. At the end
+        of the training, the weights that gave the lowest validation error are kept.
+
+    :validation_fraction: float, default 0.1
+
+        Fraction of the training set used as validation set for early stopping.
+
+    :patience: int, default 10
+
+        Number of iterations without an improvement of the validation error after which the training is stopped.
+
+    :min_delta: float, default 0.0
+
+        Smallest decrease of the validation error that counts as an improvement.
+
+    :checkpoint_dir: string or None, default None
+
+        Directory where checkpoints of the training are written. A checkpoint contains the weights, the state of the
+        Adam optimiser, the number of iterations done and the training history, so that a fit that was interrupted can
+        be continued with ``fit(X, y, resume=True)``. If None, no checkpoints are written.
+
+    :checkpoint_interval: int, default 100
+
+        Number of iterations between two checkpoints.
+
+    :warm_start: bool, default False
+
+        If True, the graph, the session and the state of the Adam optimiser are kept after fit, so that the next call
+        of fit continues the optimisation where it was left (also with new data) without rebuilding the graph. The
+        function partial_fit always does this.
+
+    :intra_op_threads: int, default 0
+
+        Number of threads used by TensorFlow to run a single operation (for example a matrix multiplication). If 0,
+        TensorFlow uses as many as there are cores. When several estimators are trained at the same time on one
+        machine, the sum of their threads should not be larger than the number of cores.
+
+    :inter_op_threads: int, default 0
+
+        Number of threads used by TensorFlow to run independent operations at the same time. If 0, TensorFlow picks
+        it.
+
+    :cpu_affinity: list of int or None, default None
+
+        CPUs to which the process is pinned when a session is opened (with psutil, on Linux and Windows). If None, the
+        process is not pinned.
+
+    :scaler: Scaling.StreamingScaler or None, default None
+
+        Fitted scaler whose mean and standard deviation are used to standardise the features. The scaling is done
+        inside the TensorFlow graph, so the scaled data is never stored, and the same scaling is used for the training,
+        the predictions and the forces. The scaler is saved with the model. If None, the features are not scaled.
+
     """
 
     def __init__(self, hidden_layer_sizes=(5,), alpha=0.0001, batch_size='auto', learning_rate_init=0.001,
-                 max_iter=80):
+                 max_iter=80, input_pipeline='feed', random_state=None, eval_interval=50, eval_batch_size=10000,
+                 early_stopping=False, validation_fraction=0.1, patience=10, min_delta=0.0, checkpoint_dir=None,
+                 checkpoint_interval=100, warm_start=False, intra_op_threads=0, inter_op_threads=0, cpu_affinity=None,
+                 scaler=None):
 
         # Initialising the parameters
         self.alpha = alpha
@@ -55,14 +135,41 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
         self.learning_rate_init = learning_rate_init
         self.max_iter = max_iter
         self.hidden_layer_sizes = hidden_layer_sizes
+        self.input_pipeline = input_pipeline
+        self.random_state = random_state
+        self.eval_interval = eval_interval
+        self.eval_batch_size = eval_batch_size
+        self.early_stopping = early_stopping
+        self.validation_fraction = validation_fraction
+        self.patience = patience
+        self.min_delta = min_delta
+        self.checkpoint_dir = checkpoint_dir
+        self.checkpoint_interval = checkpoint_interval
+        self.warm_start = warm_start
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.cpu_affinity = cpu_affinity
+        self.scaler = scaler
 
         # Initialising parameters needed for the Tensorflow part
         self.alreadyInitialised = False
         self.trainCost = []
         self.testCost = []
+        self.history = {'iteration': [], 'test_cost': [], 'test_rmse': [], 'test_mae': [], 'val_rmse': []}
         self.isVisReady = False
-
-    def fit(self, X, y, *test):
+        self._inference = None
+        self._training = None
+        self._forces = None
+
+    def __getstate__(self):
+        # The TensorFlow sessions and graphs can't be pickled, the one for the predictions is rebuilt when needed
+        state = self.__dict__.copy()
+        state['_inference'] = None
+        state['_training'] = None
+        state['_forces'] = None
+        return state
+
+    def fit(self, X, y, *test, **kwargs):
         """
         Fit the model to data matrix X and target y.
 
@@ -76,12 +183,41 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
 
         :test: list with 1st element an array of shape (n_samples, n_features) and 2nd element an array of shape (n_samples, )
 
-            This is a test set to visualise whether the model is overfitting.
+            This is a test set to visualise whether the model is overfitting. Every eval_interval iterations, the cost,
+            the root mean square error and the mean absolute error on the test set are stored in the dictionary
+            history. The test set is only used to evaluate the model, it is never used to train it.
+
+        :resume: bool, default False
+
+            If True, the training continues from the latest checkpoint in checkpoint_dir (if there is one) instead of
+            starting from the beginning. The data passed should be the same as in the interrupted fit.
 
         """
+        resume = kwargs.pop('resume', False)
+        if kwargs:
+            raise TypeError("fit() got unexpected keyword arguments %s" % (list(kwargs.keys())))
+        if resume and self.checkpoint_dir is None:
+            raise ValueError("A checkpoint_dir is needed to resume the training.")
 
         print( "Starting the fitting process ... \n")
 
+        self.__fit(X, y, test, resume=resume, n_iter=self.max_iter, keep_session=self.warm_start)
+
+    def __fit(self, X, y, test, resume, n_iter, keep_session):
+        """
+        This function trains the model. It is used by both fit and partial_fit.
+
+        :X: array of shape (n_samples, n_features)
+        :y: array of shape (n_samples,) or (n_samples, n_output)
+        :test: tuple that is either empty or contains X and y of the test set
+        :resume: bool - whether to restart from the latest checkpoint
+        :n_iter: int - number of iterations over the training set
+        :keep_session: bool - whether to reuse the graph and session of the previous call and to keep them afterwards
+        """
+
+        # Memory mapped data is read in batches by the input pipeline rather than all at once
+        is_memmap = isinstance(X, np.memmap)
+
         # Check that X and y have correct shape
         X, y = check_X_y(X, y, multi_output=True)
         # Modification of the y data, because tensorflow wants a column vector, while scikit learn uses a row vector
@@ -94,10 +230,13 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
                 raise TypeError("foo() expected 2 arguments, got %d" % (len(test)))
             X_test = test[0]
             y_test = test[1]
-            check_X_y(X_test, y_test, multi_output=True)
-            if y.ndim == 1:
+            X_test, y_test = check_X_y(X_test, y_test, multi_output=True)
+            if y_test.ndim == 1:
                 y_test = np.atleast_2d(y_test).T
 
+        if self.early_stopping:
+            X, y, X_val, y_val = self.__split_validation(X, y, is_memmap)
+
         self.n_feat = X.shape[1]
         self.n_samples = X.shape[0]
         self.n_output = y.shape[1]
@@ -105,57 +244,409 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
         # Check the value of the batch size
         self.batch_size = self.checkBatchSize()
 
-        # Initial set up of the NN
-        X_train = tf.placeholder(tf.float32, [None, self.n_feat])
-        Y_train = tf.placeholder(tf.float32, [None, self.n_output])
-
-        # This part either randomly initialises the weights and biases or restarts training from wherever it was stopped
-        if self.alreadyInitialised == False:
-            weights, biases = self.__generate_weights()
-            self.alreadyInitialised = True
-        else:
-            weights = []
-            biases = []
-
-            for ii in range(len(self.all_weights)):
-                weights.append(tf.Variable(self.all_weights[ii]))
-                biases.append(tf.Variable(self.all_biases[ii]))
-
-        model = self.modelNN(X_train, weights, biases)
-        cost = self.costReg(model, Y_train, weights, self.alpha)
-        optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate_init).minimize(cost)
-
-        # Initialisation of the variables
-        init = tf.global_variables_initializer()
-
-        # Running the graph
-        with tf.Session() as sess:
-            sess.run(init)
+        # The graph, the session and the state of the optimiser of the previous call are reused when warm starting
+        training = getattr(self, '_training', None)
+        if training is not None and (resume or not keep_session or
+                                     training['signature'] != self.__signature(is_memmap)):
+            self.__reset_training()
+            training = None
+        if training is None:
+            training = self.__build_training(is_memmap, resume)
+
+        sess = training['session']
+        X_train = training['X']
+        Y_train = training['Y']
+        model = training['model']
+        cost = training['cost']
+        optimizer = training['optimizer']
+        weights = training['weights']
+        biases = training['biases']
+
+        if self.input_pipeline == 'dataset':
+            sess.run(training['pipeline']['init'], feed_dict=training['pipeline']['feed'](X, y))
+
+        # State of the early stopping
+        es_state = {'best_rmse': np.inf, 'n_no_improvement': 0, 'best_weights': None, 'best_biases': None,
+                    'stopped': False}
+        start_iter = 0
+
+        if resume:
+            start_iter, es_state = self.__restore_checkpoint(sess, training['checkpoint'], es_state)
+
+        # The initial weights are the best ones until the validation error improves, so that there are always weights
+        # to restore at the end (also if the validation error is never finite)
+        if self.early_stopping and es_state['best_weights'] is None:
+            es_state['best_weights'], es_state['best_biases'] = sess.run([weights, biases])
+
+        for iter in range(start_iter, n_iter):
+            if es_state['stopped']:
+                break
 
-            for iter in range(self.max_iter):
+            # This will be used to calculate the average cost per iteration
+            avg_cost = 0
+            if self.input_pipeline == 'dataset':
+                # The last batch is smaller than the others, so the cost of each batch is weighted by its size
+                n_batches = int(np.ceil(self.n_samples / float(self.batch_size)))
+                n_seen = 0
+                for i in range(n_batches):
+                    opt, c, n_batch = sess.run([optimizer, cost, training['batch_size']])
+                    avg_cost += c * n_batch / float(self.n_samples)
+                    n_seen += n_batch
+                # Each iteration should be one epoch, otherwise the average cost is wrong
+                if n_seen != self.n_samples:
+                    raise RuntimeError("An iteration used %d samples instead of %d." % (n_seen, self.n_samples))
+            else:
                 # This is the total number of batches in which the training set is divided
                 n_batches = int(self.n_samples / self.batch_size)
-                # This will be used to calculate the average cost per iteration
-                avg_cost = 0
                 # Learning over the batches of data
                 for i in range(n_batches):
                     batch_x = X[i * self.batch_size:(i + 1) * self.batch_size, :]
                     batch_y = y[i * self.batch_size:(i + 1) * self.batch_size, :]
                     opt, c = sess.run([optimizer, cost], feed_dict={X_train: batch_x, Y_train: batch_y})
                     avg_cost += c / n_batches
-                if test and iter % 50 == 0:
-                    optTest, cTest = sess.run([optimizer, cost], feed_dict={X_train: X_test, Y_train: y_test})
-                    self.testCost.append(cTest)
-                self.trainCost.append(avg_cost)
-                if iter % 500 == 0:
-                    print( "Completed " + str(iter) + " iterations. \n")
-
-            # Saving the weights for later re-use
-            self.all_weights = []
-            self.all_biases = []
+            if test and iter % self.eval_interval == 0:
+                mse, rmse, mae = self.__evaluate(sess, X_train, model, X_test, y_test)
+                # The regularisation term is added so that the test cost can be compared to the training cost
+                reg_l2 = 0.5 * self.alpha * sum(np.sum(w ** 2) for w in sess.run(weights))
+                self.testCost.append(mse + reg_l2)
+                self.history['iteration'].append(len(self.trainCost))
+                self.history['test_cost'].append(mse + reg_l2)
+                self.history['test_rmse'].append(rmse)
+                self.history['test_mae'].append(mae)
+            self.trainCost.append(avg_cost)
+            if iter % 500 == 0:
+                print( "Completed " + str(iter) + " iterations. \n")
+
+            if self.early_stopping:
+                mse, rmse, mae = self.__evaluate(sess, X_train, model, X_val, y_val)
+                self.history['val_rmse'].append(rmse)
+                # A NaN validation error counts as no improvement
+                if np.isfinite(rmse) and rmse < es_state['best_rmse'] - self.min_delta:
+                    # Keeping a copy of the best weights found so far
+                    es_state['best_rmse'] = rmse
+                    es_state['n_no_improvement'] = 0
+                    es_state['best_weights'], es_state['best_biases'] = sess.run([weights, biases])
+                    self.best_iteration = len(self.trainCost) - 1
+                else:
+                    es_state['n_no_improvement'] += 1
+                    if es_state['n_no_improvement'] >= self.patience:
+                        print("The validation error has not improved for " + str(self.patience) +
+                              " iterations. Stopping after " + str(iter + 1) + " iterations. \n")
+                        es_state['stopped'] = True
+
+            if self.checkpoint_dir is not None and ((iter + 1) % self.checkpoint_interval == 0 or
+                                                    iter + 1 == n_iter or es_state['stopped']):
+                self.__save_checkpoint(sess, training['checkpoint'], iter + 1, es_state)
+
+        # Saving the weights for later re-use
+        if self.early_stopping:
+            self.all_weights = es_state['best_weights']
+            self.all_biases = es_state['best_biases']
+            # The best weights are also put back in the graph, so that a warm started fit continues from them
             for ii in range(len(weights)):
-                self.all_weights.append(sess.run(weights[ii]))
-                self.all_biases.append(sess.run(biases[ii]))
+                weights[ii].load(self.all_weights[ii], sess)
+                biases[ii].load(self.all_biases[ii], sess)
+        else:
+            self.all_weights, self.all_biases = sess.run([weights, biases])
+
+        # The weights have changed, so the graph used for the predictions has to be rebuilt
+        self.__reset_inference()
+
+        if keep_session:
+            self._training = training
+            training['all_weights'] = self.all_weights
+        else:
+            training['session'].close()
+
+    def partial_fit(self, X, y):
+        """
+        This function does one iteration of training over the data X and y. The graph, the session and the state of the
+        Adam optimiser are kept between calls, so that new data can be added to the training (for example as new high
+        level energies are calculated) without restarting the optimisation.
+
+        :X: array of shape (n_samples, n_features).
+
+            This contains the input data with samples in the rows and features in the columns.
+
+        :y: array of shape (n_samples,).
+
+            This contains the target values for each sample in the X matrix.
+        """
+        self.__fit(X, y, (), resume=False, n_iter=1, keep_session=True)
+
+    def __signature(self, is_memmap):
+        """
+        This function returns the parameters that are fixed once the training graph has been built. The graph of a
+        previous fit can only be reused if they have not changed.
+
+        :is_memmap: bool
+        :return: tuple
+        """
+        return (self.n_feat, self.n_output, tuple(self.hidden_layer_sizes), self.alpha, self.learning_rate_init,
+                self.input_pipeline, is_memmap, self.checkpoint_dir is not None, self.__scaling_key())
+
+    def __scaling_key(self):
+        """
+        This function returns the statistics of the scaler, so that the graphs that have the scaling built in can be
+        rebuilt when the scaler changes (also through set_params).
+
+        :return: None or tuple of bytes
+        """
+        if self.scaler is None:
+            return None
+
+        return (self.scaler.mean_.tobytes(), self.scaler.scale_.tobytes())
+
+    def __build_training(self, is_memmap, resume):
+        """
+        This function builds the graph used for training, in a graph of its own so that the default graph doesn't grow
+        with every call of fit, and opens a session in which the variables are initialised.
+
+        :is_memmap: bool
+        :resume: bool - if True the weights are generated at random, since they will be restored from a checkpoint
+        :return: dictionary with the session, the tensors and the operations needed for training
+        """
+        graph = tf.Graph()
+        training = {'signature': self.__signature(is_memmap), 'scaling': self.__scaling_key()}
+
+        with graph.as_default():
+            if self.random_state is not None:
+                tf.set_random_seed(self.random_state)
+
+            # Initial set up of the NN
+            if self.input_pipeline == 'dataset':
+                # The placeholders take the next batch from the pipeline unless something else is fed to them
+                pipeline = self.__input_dataset(is_memmap)
+                X_train = tf.placeholder_with_default(pipeline['next_x'], [None, self.n_feat])
+                Y_train = tf.placeholder_with_default(pipeline['next_y'], [None, self.n_output])
+                training['pipeline'] = pipeline
+                training['batch_size'] = tf.shape(X_train)[0]
+            elif self.input_pipeline == 'feed':
+                X_train = tf.placeholder(tf.float32, [None, self.n_feat])
+                Y_train = tf.placeholder(tf.float32, [None, self.n_output])
+            else:
+                raise ValueError("The input pipeline should be 'feed' or 'dataset', got '%s'." % (self.input_pipeline))
+
+            # This part either randomly initialises the weights and biases or restarts training from wherever it was stopped
+            # When resuming from a checkpoint, the weights are generated and then overwritten by the ones in the checkpoint
+            if self.alreadyInitialised == False or resume:
+                weights, biases = self.__generate_weights()
+                self.alreadyInitialised = True
+            else:
+                weights = []
+                biases = []
+
+                for ii in range(len(self.all_weights)):
+                    weights.append(tf.Variable(self.all_weights[ii]))
+                    biases.append(tf.Variable(self.all_biases[ii]))
+
+            model = self.modelNN(X_train, weights, biases)
+            cost = self.costReg(model, Y_train, weights, self.alpha)
+            optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate_init).minimize(cost)
+
+            if self.checkpoint_dir is not None:
+                # The number of iterations done is stored in the graph so that it is saved with the checkpoints
+                epoch_tf = tf.Variable(0, trainable=False, name='epoch')
+                epoch_ph = tf.placeholder(tf.int32, [])
+                training['checkpoint'] = {'saver': tf.train.Saver(max_to_keep=2), 'epoch': epoch_tf,
+                                          'set_epoch': tf.assign(epoch_tf, epoch_ph), 'epoch_ph': epoch_ph}
+
+            # Initialisation of the variables
+            init = tf.global_variables_initializer()
+
+        training['session'] = TFSession.new_session(graph, self.intra_op_threads, self.inter_op_threads,
+                                                    self.cpu_affinity)
+        training['session'].run(init)
+
+        training.update({'X': X_train, 'Y': Y_train, 'model': model, 'cost': cost, 'optimizer': optimizer,
+                         'weights': weights, 'biases': biases})
+
+        return training
+
+    def __reset_training(self):
+        """
+        This function closes the session kept open for warm starting, so that the next fit builds a new graph.
+        """
+        if getattr(self, '_training', None) is not None:
+            self._training['session'].close()
+            self._training = None
+
+    def __save_checkpoint(self, sess, checkpoint, n_iter, es_state):
+        """
+        This function writes a checkpoint of the training to checkpoint_dir. The variables of the graph (weights, biases,
+        state of the Adam optimiser and number of iterations) are saved with a tf.train.Saver, while the training history
+        and the state of the early stopping are pickled to a file labelled with the same number of iterations.
+
+        :sess: the tf.Session in which the model is being trained
+        :checkpoint: dictionary with the saver and the tensors used to store the number of iterations
+        :n_iter: int - the number of iterations done
+        :es_state: dictionary with the state of the early stopping
+        """
+        if not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+
+        state = {'trainCost': self.trainCost, 'testCost': self.testCost, 'history': self.history,
+                 'best_iteration': getattr(self, 'best_iteration', None), 'es_state': es_state}
+        state_file = os.path.join(self.checkpoint_dir, "state-%d.pkl" % (n_iter))
+        with open(state_file + ".tmp", 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(state_file + ".tmp", state_file)
+
+        sess.run(checkpoint['set_epoch'], feed_dict={checkpoint['epoch_ph']: n_iter})
+        checkpoint['saver'].save(sess, os.path.join(self.checkpoint_dir, "model.ckpt"), global_step=n_iter)
+
+        # Removing the states that belong to checkpoints that the saver has deleted
+        kept = [os.path.basename(path) for path in checkpoint['saver'].last_checkpoints]
+        for file_name in os.listdir(self.checkpoint_dir):
+            if file_name.startswith("state-") and file_name.endswith(".pkl"):
+                if "model.ckpt-" + file_name[len("state-"):-len(".pkl")] not in kept:
+                    os.remove(os.path.join(self.checkpoint_dir, file_name))
+
+    def __restore_checkpoint(self, sess, checkpoint, es_state):
+        """
+        This function restores the training from the latest checkpoint in checkpoint_dir. If there is no checkpoint, the
+        training starts from the beginning.
+
+        :sess: the tf.Session in which the model is being trained
+        :checkpoint: dictionary with the saver and the tensors used to store the number of iterations
+        :es_state: dictionary with the initial state of the early stopping
+        :return: the number of iterations already done (int) and the state of the early stopping (dictionary)
+        """
+        latest = tf.train.latest_checkpoint(self.checkpoint_dir)
+        if latest is None:
+            print("No checkpoint found in " + self.checkpoint_dir + ", starting the training from the beginning. \n")
+            return 0, es_state
+
+        checkpoint['saver'].restore(sess, latest)
+        n_iter = int(sess.run(checkpoint['epoch']))
+
+        with open(os.path.join(self.checkpoint_dir, "state-%d.pkl" % (n_iter)), 'rb') as f:
+            state = pickle.load(f)
+        self.trainCost = state['trainCost']
+        self.testCost = state['testCost']
+        self.history = state['history']
+        if state['best_iteration'] is not None:
+            self.best_iteration = state['best_iteration']
+
+        print("Resuming the training from iteration " + str(n_iter) + ". \n")
+
+        return n_iter, state['es_state']
+
+    def __split_validation(self, X, y, is_memmap):
+        """
+        This function splits the training set into the part used for training and the validation set used for early
+        stopping. The samples are picked at random (with random_state), apart from when X is a numpy memmap: then the
+        last samples are taken so that the training part doesn't have to be copied in memory.
+
+        :X: array of shape (n_samples, n_features)
+        :y: array of shape (n_samples, n_output)
+        :is_memmap: bool
+        :return: X and y for training and X and y for validation
+        """
+        n_val = int(np.ceil(self.validation_fraction * X.shape[0]))
+        if n_val < 1 or n_val >= X.shape[0]:
+            raise ValueError("The validation fraction %s leaves no samples for training or for validation."
+                             % (self.validation_fraction))
+
+        if is_memmap:
+            return X[:-n_val], y[:-n_val], X[-n_val:], y[-n_val:]
+
+        permutation = np.random.RandomState(self.random_state).permutation(X.shape[0])
+        idx_train = permutation[n_val:]
+        idx_val = permutation[:n_val]
+
+        return X[idx_train], y[idx_train], X[idx_val], y[idx_val]
+
+    def __evaluate(self, sess, X_tf, model, X_eval, y_eval):
+        """
+        This function evaluates the model on a data set without changing the weights. Only the output of the model is
+        calculated, in batches of eval_batch_size samples, and the errors are accumulated in numpy.
+
+        :sess: the tf.Session in which the model is being trained
+        :X_tf: the tensor of the input of the model
+        :model: the tensor of the output of the model
+        :X_eval: array of shape (n_samples, n_features)
+        :y_eval: array of shape (n_samples, n_output)
+        :return: the mean square error, the root mean square error and the mean absolute error (floats)
+        """
+        sum_sq = 0.0
+        sum_abs = 0.0
+
+        for start in range(0, X_eval.shape[0], self.eval_batch_size):
+            y_pred = sess.run(model, feed_dict={X_tf: X_eval[start:start + self.eval_batch_size]})
+            diff = y_pred - y_eval[start:start + self.eval_batch_size]
+            sum_sq += np.sum(diff ** 2)
+            sum_abs += np.sum(np.abs(diff))
+
+        n_values = float(y_eval.size)
+        mse = sum_sq / n_values
+
+        return mse, np.sqrt(mse), sum_abs / n_values
+
+    def __input_dataset(self, is_memmap):
+        """
+        This function builds the tf.data pipeline used to train the model when input_pipeline is 'dataset'. The data is
+        shuffled at each iteration with a seed that depends on random_state, it is split into batches of batch_size
+        samples (the last one can be smaller) and the next batch is prefetched while the current one is being used.
+
+        If X is a numpy memmap, the batches are read from it by a python generator, so that the whole data set is never
+        loaded in memory. Otherwise the data is copied into the pipeline once, when it is initialised. The data is only
+        passed when the pipeline is initialised, so the same pipeline can be reused with new data.
+
+        :is_memmap: bool
+        :return: dictionary with the initialiser of the pipeline ('init'), a function that takes X and y and returns
+            the feed_dict needed to run the initialiser ('feed') and the tensors with the next batch of X and y
+            ('next_x' and 'next_y')
+        """
+        if is_memmap:
+            # The generator reads the data that was passed last time that the pipeline was initialised
+            source = {}
+            seed = self.random_state
+
+            def generate_batches():
+                X, y, batch_size = source['X'], source['y'], source['batch_size']
+                random_state = np.random.RandomState(seed)
+                while True:
+                    permutation = random_state.permutation(X.shape[0])
+                    for start in range(0, X.shape[0], batch_size):
+                        # Sorting the indexes makes the reads from the memory mapped file more sequential
+                        idx = np.sort(permutation[start:start + batch_size])
+                        yield X[idx].astype(np.float32, copy=False), y[idx].astype(np.float32, copy=False)
+
+            def feed(X, y):
+                source.update({'X': X, 'y': y, 'batch_size': self.batch_size})
+                return {}
+
+            dataset = tf.data.Dataset.from_generator(generate_batches, (tf.float32, tf.float32),
+                                                     (tf.TensorShape([None, self.n_feat]),
+                                                      tf.TensorShape([None, self.n_output])))
+        else:
+            X_all = tf.placeholder(tf.float32, [None, self.n_feat])
+            y_all = tf.placeholder(tf.float32, [None, self.n_output])
+            n_samples = tf.placeholder(tf.int64, [])
+            batch_size = tf.placeholder(tf.int64, [])
+
+            def feed(X, y):
+                # np.asarray doesn't copy data that is already float32
+                return {X_all: np.asarray(X, dtype=np.float32), y_all: np.asarray(y, dtype=np.float32),
+                        n_samples: X.shape[0], batch_size: self.batch_size}
+
+            dataset = tf.data.Dataset.from_tensor_slices((X_all, y_all))
+            dataset = dataset.shuffle(buffer_size=n_samples, seed=self.random_state, reshuffle_each_iteration=True)
+            # Batching before repeating makes each iteration exactly one epoch, ending with the smaller last batch
+            dataset = dataset.batch(batch_size).repeat()
+
+        # The next batches are staged on the GPU if there is one, otherwise they are just prefetched
+        gpu_name = tf.test.gpu_device_name()
+        if gpu_name:
+            dataset = dataset.apply(tf.data.experimental.prefetch_to_device(gpu_name))
+        else:
+            dataset = dataset.prefetch(1)
+
+        iterator = dataset.make_initializable_iterator()
+        next_x, next_y = iterator.get_next()
+
+        return {'init': iterator.initializer, 'feed': feed, 'next_x': next_x, 'next_y': next_y}
 
     def modelNN(self, X, weights, biases):
         """
@@ -168,6 +659,11 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
         :return: tf.Variable of size (n_samples, 1)
         """
 
+        # Standardising the features with the statistics of the scaler
+        if self.scaler is not None:
+            X = (X - tf.constant(self.scaler.mean_, dtype=tf.float32)) / tf.constant(self.scaler.scale_,
+                                                                                     dtype=tf.float32)
+
         # Calculating the activation of the first hidden layer
         z = tf.add(tf.matmul(X, tf.transpose(weights[0])), biases[0])
         h = tf.nn.sigmoid(z)
@@ -253,12 +749,13 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
     def plotLearningCurve(self):
         """
         This function plots the cost versus the number of iterations for the training set and the test set in the
-        same plot. The cost on the train set is calculated every 50 iterations.
+        same plot. The cost on the test set is calculated every eval_interval iterations.
         """
+        import matplotlib.pyplot as plt
+
         fig, ax = plt.subplots(figsize=(6, 6))
         ax.plot(self.trainCost, label="Train set", color="b")
-        iterTest = range(0, self.max_iter, 50)
-        ax.plot(iterTest, self.testCost, label="Test set", color="red")
+        ax.plot(self.history['iteration'], self.history['test_cost'], label="Test set", color="red")
         ax.set_xlabel('Number of iterations')
         ax.set_ylabel('Cost Value')
         ax.legend()
@@ -297,14 +794,27 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
         else:
             return True
 
-    def predict(self, X):
+    def predict(self, X, chunk_size=None, out=None):
         """
-        This function uses the X data and plugs it into the model and then returns the predicted y
+        This function uses the X data and plugs it into the model and then returns the predicted y. The data is passed
+        to the network in chunks of chunk_size samples and the predictions are written into a preallocated array, so
+        only one chunk of X (converted to float32) and its activations are in memory at once. This way, X can be a
+        numpy memmap that doesn't fit in memory.
 
-        :X: array of shape (n_samples, n_features)
+        :X: array of shape (n_samples, n_features), numpy memmap of that shape or iterable (for example a generator) of
+            arrays of shape (n_samples_in_chunk, n_features)
 
             This contains the input data with samples in the rows and features in the columns.
 
+        :chunk_size: int or None, default None
+
+            Number of samples passed to the network at once. If None, eval_batch_size is used.
+
+        :out: array of shape (n_samples, n_output) or None, default None
+
+            Array where the predictions are written (for example a numpy memmap). If None, a new array is allocated.
+            When X is an iterable, the number of samples is not known in advance, so out is not used.
+
         :return: array of size (n_samples, n_output)
 
             This contains the predictions for the target values corresponding to the samples contained in X.
@@ -313,8 +823,80 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
         print( "Calculating the predictions. \n")
 
         if self.checkIsFitted():
-            check_array(X)
+            if chunk_size is None:
+                chunk_size = self.eval_batch_size
+
+            inference = self.__get_inference()
+
+            def predict_chunks(X_part):
+                for start in range(0, X_part.shape[0], chunk_size):
+                    chunk = check_array(X_part[start:start + chunk_size], dtype=np.float32)
+                    yield start, inference['session'].run(inference['model'], feed_dict={inference['X']: chunk})
+
+            if isinstance(X, (list, tuple)):
+                X = np.asarray(X)
+
+            if not hasattr(X, 'shape'):
+                predictions = []
+                for X_part in X:
+                    predictions.extend(y_chunk for _, y_chunk in predict_chunks(X_part))
+                return np.reshape(np.concatenate(predictions, axis=0), (-1, self.n_output))
+
+            if out is None:
+                out = np.empty((X.shape[0], self.n_output), dtype=np.float32)
+
+            for start, y_chunk in predict_chunks(X):
+                out[start:start + chunk_size] = y_chunk
+
+            return out
+        else:
+            raise StandardError("The fit function has not been called yet, so the model has not been trained yet.")
+
+    def predict_average(self, X, n_perm, chunk_size=None):
+        """
+        This function averages the predictions over several permutations of the descriptor of each sample, for models
+        trained on randomly sorted or partially randomised Coulomb matrices. The n_perm permutations of each sample have
+        to be in consecutive rows of X, as returned by CoulombMatrix.generatePermutedCM (which makes them on the fly in
+        chunks). The rows are evaluated in chunks as in predict, so all the permutations of a chunk of samples are
+        evaluated with one matrix multiplication per layer.
+
+        :X: array of shape (n_samples*n_perm, n_features) or iterable of arrays of shape
+            (n_samples_in_chunk*n_perm, n_features)
+        :n_perm: int - number of permutations of each sample
+        :chunk_size: int or None, default None - number of rows passed to the network at once. If None,
+            eval_batch_size is used.
+        :return: arrays of shape (n_samples, n_output) with the mean and the standard deviation of the predictions of
+            the permutations of each sample
+        """
+        predictions = self.predict(X, chunk_size=chunk_size)
+        predictions = np.reshape(predictions, (-1, n_perm, self.n_output))
+
+        return np.mean(predictions, axis=1), np.std(predictions, axis=1)
+
+    def __get_inference(self):
+        """
+        This function returns the graph used to make the predictions. The graph is built only once in a graph of its
+        own, with the weights stored as variables, and the session is kept open between calls of predict. The graph is
+        only rebuilt if the weights or the scaler have changed since it was built. If the session used for training has been kept
+        open (warm start), it is used directly.
+
+        :return: dictionary with the session ('session'), the input placeholder ('X') and the output of the model
+            ('model')
+        """
+        training = getattr(self, '_training', None)
+        scaling = self.__scaling_key()
+        if training is not None and training['all_weights'] is self.all_weights and training['scaling'] == scaling:
+            return {'session': training['session'], 'X': training['X'], 'model': training['model']}
+
+        if getattr(self, '_inference', None) is not None and self._inference['weights'] is self.all_weights \
+                and self._inference['scaling'] == scaling:
+            return self._inference
+
+        self.__reset_inference()
 
+        graph = tf.Graph()
+
+        with graph.as_default():
             X_test = tf.placeholder(tf.float32, [None, self.n_feat])
 
             weights = []
@@ -328,15 +910,123 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
 
             init = tf.global_variables_initializer()
 
-            with tf.Session() as sess:
-                sess.run(init)
-                predictions = sess.run(model, feed_dict={X_test: X})
-                predictions = np.reshape(predictions,(predictions.shape[0],self.n_output))
+        sess = TFSession.new_session(graph, self.intra_op_threads, self.inter_op_threads, self.cpu_affinity)
+        sess.run(init)
+
+        self._inference = {'session': sess, 'X': X_test, 'model': model, 'weights': self.all_weights,
+                           'scaling': scaling}
+
+        return self._inference
+
+    def __reset_inference(self):
+        """
+        This function closes the sessions used for the predictions, so that the graphs are rebuilt the next time that
+        predict or predict_forces are called.
+        """
+        if getattr(self, '_inference', None) is not None:
+            self._inference['session'].close()
+            self._inference = None
+
+        if getattr(self, '_forces', None) is not None:
+            self._forces['session'].close()
+            self._forces = None
+
+    def predict_forces(self, coord, descriptor):
+        """
+        This function calculates the energies and the forces acting on the atoms for a batch of configurations. The
+        forces are minus the gradient of the energy predicted by the network with respect to the cartesian coordinates.
+        The gradient is calculated analytically by TensorFlow through both the network and the descriptor, so the
+        energies and the forces of all the configurations are obtained in one pass.
+
+        :coord: array of shape (n_samples, n_atoms, 3) with the coordinates of the atoms
+        :descriptor: function that takes a tf.Tensor of coordinates of shape (n_samples, n_atoms, 3) and returns the
+            descriptor used to train the network as a tf.Tensor of shape (n_samples, n_features). For example, the
+            function tf_descriptor of a CoulombMatrix object.
+        :return: array of shape (n_samples, 1) with the energies and array of shape (n_samples, n_atoms, 3) with the
+            forces
+        """
+        if self.checkIsFitted():
+            if self.n_output != 1:
+                raise ValueError("The forces can only be calculated for a network with one output (the energy).")
 
-            return predictions
+            coord = np.asarray(coord, dtype=np.float32)
+            if coord.ndim != 3 or coord.shape[2] != 3:
+                raise ValueError("The coordinates should have shape (n_samples, n_atoms, 3), got %s." % (coord.shape,))
+
+            forces = self.__get_forces(descriptor, coord.shape[1])
+
+            return forces['session'].run([forces['energy'], forces['forces']], feed_dict={forces['coord']: coord})
         else:
             raise StandardError("The fit function has not been called yet, so the model has not been trained yet.")
 
+    def inference_graph(self, X):
+        """
+        This function adds to the default graph the operations that calculate the predictions of the trained network
+        for the tensor X. The weights and the scaling are constants, so the graph doesn't need to be initialised and can
+        be exported as a frozen graph (see Export.export_model).
+
+        :X: tf.Tensor of shape (n_samples, n_features)
+        :return: tf.Tensor of shape (n_samples, n_output)
+        """
+        self.checkIsFitted()
+
+        weights = [tf.constant(w, dtype=tf.float32) for w in self.all_weights]
+        biases = [tf.constant(b, dtype=tf.float32) for b in self.all_biases]
+
+        return self.modelNN(X, weights, biases)
+
+    def forces_graph(self, coord, descriptor):
+        """
+        This function adds to the default graph the operations that calculate the energies and the forces for the tensor
+        of coordinates coord, with the weights as constants (as in inference_graph). The forces are minus the gradient
+        of the energies with respect to coord, through both the network and the descriptor.
+
+        :coord: tf.Tensor of shape (n_samples, n_atoms, 3)
+        :descriptor: function that takes coord and returns the descriptor as a tf.Tensor of shape
+            (n_samples, n_features)
+        :return: tf.Tensor of shape (n_samples, 1) with the energies and tf.Tensor of shape (n_samples, n_atoms, 3) with
+            the forces
+        """
+        energy = self.inference_graph(descriptor(coord))
+        # The configurations are independent, so the gradient of the sum of the energies is the gradient of each energy
+        # with respect to the coordinates of its own configuration
+        forces = tf.negative(tf.gradients(tf.reduce_sum(energy), coord)[0])
+
+        return energy, forces
+
+    def __get_forces(self, descriptor, n_atoms):
+        """
+        This function returns the graph that calculates the energies and their gradient with respect to the
+        coordinates. Like the graph used by predict, it is built once in a graph of its own and the session is kept
+        open. It is rebuilt if the weights, the scaler, the descriptor or the number of atoms change.
+
+        :descriptor: function that takes a tf.Tensor of coordinates and returns the descriptor
+        :n_atoms: int
+        :return: dictionary with the session ('session'), the coordinates placeholder ('coord'), the energies
+            ('energy') and the forces ('forces')
+        """
+        forces = getattr(self, '_forces', None)
+        scaling = self.__scaling_key()
+        if forces is not None and forces['weights'] is self.all_weights and forces['descriptor'] == descriptor \
+                and forces['n_atoms'] == n_atoms and forces['scaling'] == scaling:
+            return forces
+
+        if forces is not None:
+            forces['session'].close()
+
+        graph = tf.Graph()
+
+        with graph.as_default():
+            coord = tf.placeholder(tf.float32, [None, n_atoms, 3])
+            energy, forces_tf = self.forces_graph(coord, descriptor)
+
+        sess = TFSession.new_session(graph, self.intra_op_threads, self.inter_op_threads, self.cpu_affinity)
+
+        self._forces = {'session': sess, 'coord': coord, 'energy': energy, 'forces': forces_tf,
+                        'weights': self.all_weights, 'descriptor': descriptor, 'n_atoms': n_atoms, 'scaling': scaling}
+
+        return self._forces
+
     def score(self, X, y, sample_weight=None):
         """
         Returns the mean accuracy on the given test data and labels. It calculates the R^2 value. It is used during the
@@ -447,6 +1137,9 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
 
             This contains the target values for each sample in the X matrix.
         """
+        import matplotlib.pyplot as plt
+        import pandas as pd
+
         y_pred = self.predict(X)
         diff_kJmol = (y - y_pred)*2625.50
         df = pd.Series(diff_kJmol, name="Error (kJ/mol)")
@@ -476,6 +1169,10 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
 
             These are the limits of the x values for the plot.
         """
+        import matplotlib.pyplot as plt
+        import pandas as pd
+        import seaborn as sns
+
         y_pred = self.predict(X)
         df = pd.DataFrame()
         df['High level calculated energies (Ha)'] = y
@@ -490,6 +1187,9 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
         """
         This function plots the weights of the first layer of the neural network as a heat map.
         """
+        import matplotlib.pyplot as plt
+        import pandas as pd
+        import seaborn as sns
 
         w1_square_tot = []
 
@@ -587,7 +1287,7 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
 
 
             # Running the graph
-            with tf.Session() as sess:
+            with TFSession.new_session(None, self.intra_op_threads, self.inter_op_threads, self.cpu_affinity) as sess:
                 sess.run(init)
 
                 for i in range(iterations):
@@ -618,6 +1318,9 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
 
             If this is true, the plot is written to a png file.
         """
+        import matplotlib.pyplot as plt
+        import pandas as pd
+        import seaborn as sns
 
         if self.isVisReady == False:
             self.x_square_tot = self.__vis_input(initial_guess)
@@ -659,6 +1362,7 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
 
             If this is true, the plot is written to a png file.
         """
+        import matplotlib.pyplot as plt
         import networkx as nx
 
         if self.isVisReady == False:
@@ -712,6 +1416,8 @@ class MLPRegFlow(BaseEstimator, ClassifierMixin):
 
 if __name__ == "__main__":
 
+    import matplotlib.pyplot as plt
+
     estimator = MLPRegFlow(hidden_layer_sizes=(5, 5, 5), learning_rate_init=0.01, max_iter=5000, alpha=0)
     x = np.arange(-2.0, 2.0, 0.05)
     X = np.atleast_2d(x).T
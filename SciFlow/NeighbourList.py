@@ -0,0 +1,160 @@
+"""
+This module finds the pairs of atoms that are closer than a cut off radius, so that the descriptors of large systems
+only need to be calculated for the pairs of atoms that are close to each other instead of for all the N^2 pairs.
+
+The pairs can be found either with a cell list (the space is divided into cubic cells of side equal to the cut off, so
+that only the atoms in neighbouring cells need to be compared) or with the KD-tree of scipy. Both scale as O(N).
+
+When the configurations are consecutive frames of a molecular dynamics trajectory, the list can be built with a radius
+of r_cut + skin and reused for the following frames until one of the atoms has moved by more than skin/2. In this case
+only the distances of the pairs in the list need to be recalculated.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Offsets of half of the 26 neighbouring cells, so that each pair of cells is only visited once
+_HALF_SHELL = [(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1) if (i, j, k) > (0, 0, 0)]
+
+
+class NeighbourList():
+    """
+    This class finds all the pairs of atoms i < j that are closer than r_cut.
+
+    :r_cut: float - cut off radius
+    :skin: float, default 0.0 - extra distance added to the cut off when the list is built. If it is larger than 0, the
+        list is reused for new configurations until one of the atoms moves by more than skin/2.
+    :method: string, 'kdtree' or 'cell' - algorithm used to build the list
+    """
+
+    def __init__(self, r_cut, skin=0.0, method='kdtree'):
+
+        if method not in ('kdtree', 'cell'):
+            raise ValueError("The method should be 'kdtree' or 'cell', got %s." % method)
+
+        self.r_cut = r_cut
+        self.skin = skin
+        self.method = method
+
+        # Number of times that the list has been built from scratch
+        self.n_builds = 0
+        self.__ref_coord = None
+        self.__candidates = None
+
+    def update(self, coord):
+        """
+        This function returns the pairs of atoms closer than r_cut in the configuration coord. The list of candidate
+        pairs is only rebuilt if it cannot be reused.
+
+        :coord: numpy array of shape (n_atoms, 3)
+        :return: numpy arrays of shape (n_pairs,) with the index of the first atom, the index of the second atom and the
+            distance between them
+        """
+        coord = np.asarray(coord, dtype=np.float64)
+
+        if self.__needs_build(coord):
+            self.__candidates = self.__build(coord, self.r_cut + self.skin)
+            self.__ref_coord = coord.copy()
+            self.n_builds += 1
+
+        idx_i, idx_j = self.__candidates
+        dist = np.sqrt(np.sum((coord[idx_i] - coord[idx_j]) ** 2, axis=1))
+        inside = dist < self.r_cut
+
+        return idx_i[inside], idx_j[inside], dist[inside]
+
+    def __needs_build(self, coord):
+        """
+        This function checks whether the list of candidate pairs can be reused for a new configuration.
+
+        :coord: numpy array of shape (n_atoms, 3)
+        :return: bool
+        """
+        if self.__ref_coord is None or self.__ref_coord.shape != coord.shape or self.skin <= 0.0:
+            return True
+
+        max_displacement = np.sqrt(np.max(np.sum((coord - self.__ref_coord) ** 2, axis=1)))
+
+        return max_displacement > 0.5 * self.skin
+
+    def __build(self, coord, radius):
+        """
+        This function finds all the pairs of atoms i < j closer than radius.
+
+        :coord: numpy array of shape (n_atoms, 3)
+        :radius: float
+        :return: two numpy arrays of shape (n_pairs,), sorted by the first and then the second index
+        """
+        if self.method == 'kdtree':
+            pairs = cKDTree(coord).query_pairs(radius, output_type='ndarray')
+            idx_i, idx_j = pairs[:, 0], pairs[:, 1]
+        else:
+            idx_i, idx_j = self.__cell_list(coord, radius)
+
+        order = np.lexsort((idx_j, idx_i))
+
+        return idx_i[order].astype(np.intp), idx_j[order].astype(np.intp)
+
+    def __cell_list(self, coord, radius):
+        """
+        This function finds the pairs of atoms closer than radius with a cell list. Each atom is only compared to the
+        atoms in its own cell and in the neighbouring cells.
+
+        :coord: numpy array of shape (n_atoms, 3)
+        :radius: float
+        :return: two numpy arrays with the indexes of the atoms in each pair, where idx_i < idx_j
+        """
+        cell_idx = np.floor((coord - coord.min(axis=0)) / radius).astype(np.intp)
+        n_cells = cell_idx.max(axis=0) + 1
+        cell_id = np.ravel_multi_index(cell_idx.T, n_cells)
+
+        # Atoms sorted by cell, so that the atoms of each cell are contiguous
+        order = np.argsort(cell_id, kind='mergesort')
+        occupied, starts, counts = np.unique(cell_id[order], return_index=True, return_counts=True)
+        cells = dict(zip(occupied, zip(starts, counts)))
+
+        all_i, all_j = [], []
+        for cell, (start, count) in cells.items():
+            atoms = order[start:start + count]
+            position = np.unravel_index(cell, n_cells)
+
+            # Pairs inside the cell
+            ii, jj = np.triu_indices(count, k=1)
+            all_i.append(atoms[ii])
+            all_j.append(atoms[jj])
+
+            # Pairs with the atoms in the neighbouring cells
+            for offset in _HALF_SHELL:
+                neighbour = tuple(p + o for p, o in zip(position, offset))
+                if any(n < 0 or n >= m for n, m in zip(neighbour, n_cells)):
+                    continue
+                neighbour = np.ravel_multi_index(neighbour, n_cells)
+                if neighbour not in cells:
+                    continue
+                n_start, n_count = cells[neighbour]
+                other = order[n_start:n_start + n_count]
+                ii, jj = np.meshgrid(atoms, other, indexing='ij')
+                all_i.append(ii.ravel())
+                all_j.append(jj.ravel())
+
+        idx_i = np.concatenate(all_i)
+        idx_j = np.concatenate(all_j)
+        dist = np.sqrt(np.sum((coord[idx_i] - coord[idx_j]) ** 2, axis=1))
+        inside = dist < radius
+
+        return np.minimum(idx_i, idx_j)[inside], np.maximum(idx_i, idx_j)[inside]
+
+
+def frames(matrixX):
+    """
+    This function goes through the configurations in the raw data format of ImportData and returns the atom labels and
+    the coordinates of each of them.
+
+    :matrixX: list of lists, where each of the inner lists represents a sample configuration. An example is shown
+        below: [ [ 'C', 0.1, 0.3, 0.5, 'H', 0.0, 0.5 1.0, 'H', 0.0, -0.5, -1.0, ....], [...], ... ].
+    :return: generator of tuples with a list of the atom labels and a numpy array of shape (n_atoms, 3)
+    """
+    for sample in matrixX:
+        labels = sample[0::4]
+        coord = np.array([sample[i + 1:i + 4] for i in range(0, len(sample), 4)], dtype=np.float64)
+        yield labels, coord
@@ -0,0 +1,363 @@
+"""
+This module evaluates neural networks trained with MLPRegFlow or BPNN using only numpy. It does not import TensorFlow,
+so it can be used to make predictions quickly (for example from a molecular dynamics code that needs the energy
+millions of times) once the weights have been obtained.
+
+The weights and biases are used in the same format as the attributes all_weights and all_biases of the estimators:
+for each layer, the weights have shape (n_neurons_out, n_neurons_in) and the biases have shape (n_neurons_out,).
+
+The networks can also be evaluated in reduced precision ('float16' or 'bfloat16'). In this case the weights, the inputs
+and the activations of each layer are rounded to the reduced precision, while the matrix multiplications accumulate in
+float32, as on hardware with native support for these formats. The function check_precision compares the predictions
+with those obtained in double precision.
+"""
+
+import numpy as np
+
+
+def sigmoid(z):
+    """
+    This function calculates the sigmoid of z in a numerically stable way.
+
+    :z: numpy array
+    :return: numpy array of the same shape as z
+    """
+    return 0.5 * (np.tanh(0.5 * z) + 1.0)
+
+
+def round_float16(a):
+    """
+    This function rounds an array to the nearest half precision numbers and returns them as float32.
+
+    :a: numpy array
+    :return: numpy array of float32
+    """
+    return np.asarray(a).astype(np.float16).astype(np.float32)
+
+
+def round_bfloat16(a):
+    """
+    This function rounds an array to the nearest bfloat16 numbers (float32 numbers with only the 7 most significant bits
+    of the mantissa, rounding half to even) and returns them as float32.
+
+    :a: numpy array
+    :return: numpy array of float32
+    """
+    bits = np.ascontiguousarray(a, dtype=np.float32).view(np.uint32)
+    rounded = (bits + np.uint32(0x7FFF) + ((bits >> np.uint32(16)) & np.uint32(1))) & np.uint32(0xFFFF0000)
+
+    return rounded.view(np.float32)
+
+
+ACTIVATIONS = {
+    'sigmoid': sigmoid,
+    'tanh': np.tanh
+}
+
+REDUCED_PRECISIONS = {
+    'float16': round_float16,
+    'bfloat16': round_bfloat16
+}
+
+
+def forward(X, weights_t, biases, activation, round_fn=None):
+    """
+    This function evaluates a feed forward neural network where all the hidden layers have the same activation
+    function and the output layer is linear.
+
+    :X: numpy array of shape (n_samples, n_features)
+    :weights_t: list of the *transposed* weights of each layer, numpy arrays of shape (n_neurons_in, n_neurons_out)
+    :biases: list of the biases of each layer, numpy arrays of shape (n_neurons_out,)
+    :activation: function applied to the hidden layers
+    :round_fn: function or None - if given, it is applied to the input and to the activations of each hidden layer to
+        round them to a reduced precision
+    :return: numpy array of shape (n_samples, n_output)
+    """
+    h = X if round_fn is None else round_fn(X)
+    for ii in range(len(weights_t) - 1):
+        h = activation(np.dot(h, weights_t[ii]) + biases[ii])
+        if round_fn is not None:
+            h = round_fn(h)
+
+    return np.dot(h, weights_t[-1]) + biases[-1]
+
+
+def _prepare(weights, biases, dtype):
+    """
+    This function transposes the weights and converts the weights and biases to the precision used for the predictions.
+
+    :weights: list of numpy arrays of shape (n_neurons_out, n_neurons_in)
+    :biases: list of numpy arrays of shape (n_neurons_out,)
+    :dtype: None, numpy dtype, 'float16' or 'bfloat16'
+    :return: the transposed weights, the biases, the dtype of the calculation and the rounding function (or None)
+    """
+    round_fn = REDUCED_PRECISIONS.get(dtype) if isinstance(dtype, str) else None
+
+    if round_fn is not None:
+        compute_dtype = np.dtype(np.float32)
+    elif dtype is None:
+        compute_dtype = np.asarray(weights[0]).dtype
+    else:
+        compute_dtype = np.dtype(dtype)
+
+    # The weights are transposed and made contiguous once, so that each layer is a single matmul
+    weights_t = [np.ascontiguousarray(np.asarray(w, dtype=compute_dtype).T) for w in weights]
+    biases = [np.asarray(b, dtype=compute_dtype) for b in biases]
+    if round_fn is not None:
+        weights_t = [round_fn(w) for w in weights_t]
+        biases = [round_fn(b) for b in biases]
+
+    return weights_t, biases, compute_dtype, round_fn
+
+
+def _fold_scaler(weights, biases, mean, scale):
+    """
+    This function folds the standardisation of the features into the first layer, so that the network takes the
+    unscaled features: W (x - mean)/scale + b = (W/scale) x + (b - (W/scale) mean).
+
+    :weights: list of numpy arrays of shape (n_neurons_out, n_neurons_in)
+    :biases: list of numpy arrays of shape (n_neurons_out,)
+    :mean: numpy array of shape (n_features,)
+    :scale: numpy array of shape (n_features,)
+    :return: the new lists of weights and biases (only the first layer is copied, with the dtype of the weights)
+    """
+    weights = list(weights)
+    biases = list(biases)
+    dtype = np.asarray(weights[0]).dtype
+
+    # The folding is done in double precision and only the result is rounded
+    w_folded = np.asarray(weights[0], dtype=np.float64) / scale
+    b_folded = np.asarray(biases[0], dtype=np.float64) - np.dot(w_folded, mean)
+    weights[0] = w_folded.astype(dtype)
+    biases[0] = b_folded.astype(dtype)
+
+    return weights, biases
+
+
+def _compare(predictions, reference):
+    """
+    This function measures the difference between predictions and the reference predictions.
+
+    :predictions: numpy array
+    :reference: numpy array of the same shape
+    :return: dictionary with the largest absolute error ('max_abs_error'), the root mean square error ('rmse') and the
+        largest error relative to the range of the reference predictions ('max_rel_error')
+    """
+    diff = np.asarray(predictions, dtype=np.float64) - reference
+    scale = max(np.ptp(reference), np.finfo(np.float64).tiny)
+
+    return {'max_abs_error': np.max(np.abs(diff)), 'rmse': np.sqrt(np.mean(diff ** 2)),
+            'max_rel_error': np.max(np.abs(diff)) / scale}
+
+
+class NumpyMLP():
+    """
+    This class makes predictions with the weights of a trained MLPRegFlow estimator. The data is evaluated in chunks of
+    chunk_size samples, so that the memory used by the activations doesn't depend on the number of samples.
+
+    :weights: list of numpy arrays of shape (n_neurons_out, n_neurons_in)
+    :biases: list of numpy arrays of shape (n_neurons_out,)
+    :activation: string, 'sigmoid' or 'tanh' - activation function of the hidden layers
+    :chunk_size: int, default 10000
+    :dtype: None, numpy dtype, 'float16' or 'bfloat16', default None - precision of the predictions. If None, the dtype
+        of the weights is used.
+    """
+
+    def __init__(self, weights, biases, activation='sigmoid', chunk_size=10000, dtype=None):
+
+        self.activation = activation
+        self.chunk_size = chunk_size
+        self.__weights = weights
+        self.__biases = biases
+
+        self.weights_t, self.biases, self.dtype, self.round_fn = _prepare(weights, biases, dtype)
+        self.n_feat = self.weights_t[0].shape[0]
+        self.n_output = self.weights_t[-1].shape[1]
+
+    @classmethod
+    def from_estimator(cls, estimator, chunk_size=10000, dtype=None):
+        """
+        This function creates a NumpyMLP from a trained MLPRegFlow estimator.
+
+        If the estimator has a scaler, the scaling is folded into the weights and the biases of the first layer, so the
+        NumpyMLP takes the unscaled features.
+
+        :estimator: MLPRegFlow object that has already been fitted
+        :chunk_size: int, default 10000
+        :dtype: None, numpy dtype, 'float16' or 'bfloat16', default None
+        :return: NumpyMLP object
+        """
+        weights = estimator.all_weights
+        biases = estimator.all_biases
+
+        scaler = getattr(estimator, 'scaler', None)
+        if scaler is not None:
+            weights, biases = _fold_scaler(weights, biases, scaler.mean_, scaler.scale_)
+
+        return cls(weights, biases, activation='sigmoid', chunk_size=chunk_size, dtype=dtype)
+
+    def astype(self, dtype):
+        """
+        This function returns a copy of the network that makes the predictions with another precision.
+
+        :dtype: None, numpy dtype, 'float16' or 'bfloat16'
+        :return: NumpyMLP object
+        """
+        return NumpyMLP(self.__weights, self.__biases, self.activation, self.chunk_size, dtype)
+
+    def check_precision(self, X):
+        """
+        This function compares the predictions made with the precision of this network to those made in double
+        precision with the same weights.
+
+        :X: array of shape (n_samples, n_features)
+        :return: dictionary with the largest absolute error ('max_abs_error'), the root mean square error ('rmse') and
+            the largest error relative to the range of the double precision predictions ('max_rel_error')
+        """
+        return _compare(self.predict(X), self.astype(np.float64).predict(X))
+
+    def predict(self, X):
+        """
+        This function returns the predictions of the neural network for the samples in X.
+
+        :X: array of shape (n_samples, n_features)
+        :return: array of shape (n_samples, n_output)
+        """
+        activation = ACTIVATIONS[self.activation]
+        X = np.asarray(X)
+        n_samples = X.shape[0]
+
+        if n_samples <= self.chunk_size:
+            return forward(X.astype(self.dtype, copy=False), self.weights_t, self.biases, activation, self.round_fn)
+
+        predictions = np.empty((n_samples, self.n_output), dtype=self.dtype)
+        for start in range(0, n_samples, self.chunk_size):
+            chunk = X[start:start + self.chunk_size].astype(self.dtype, copy=False)
+            predictions[start:start + self.chunk_size] = forward(chunk, self.weights_t, self.biases, activation,
+                                                                 self.round_fn)
+
+        return predictions
+
+
+class NumpyBPNN():
+    """
+    This class makes predictions with the weights of a trained BPNN estimator. The descriptors of all the atoms of the
+    same element are stacked together, so that each element network is evaluated with one matmul per layer for all
+    the atoms of that element. The data is evaluated in chunks of chunk_size samples.
+
+    :weights: dictionary where the key is the atom label and the value is a list of numpy arrays of shape
+        (n_neurons_out, n_neurons_in)
+    :biases: dictionary where the key is the atom label and the value is a list of numpy arrays of shape
+        (n_neurons_out,)
+    :labels: list of tuples with the atom label and the number of features for each atom, as in BPNN
+    :activation: string, 'sigmoid' or 'tanh' - activation function of the hidden layers
+    :chunk_size: int, default 10000
+    :dtype: None, numpy dtype, 'float16' or 'bfloat16', default None - precision of the predictions. If None, the dtype
+        of the weights is used.
+    """
+
+    def __init__(self, weights, biases, labels, activation='tanh', chunk_size=10000, dtype=None):
+
+        self.labels = labels
+        self.activation = activation
+        self.chunk_size = chunk_size
+        self.__weights = weights
+        self.__biases = biases
+
+        self.weights_t = {}
+        self.biases = {}
+        for key in weights:
+            self.weights_t[key], self.biases[key], self.dtype, self.round_fn = _prepare(weights[key], biases[key],
+                                                                                         dtype)
+
+        # For each element, the indexes of the columns of X with the features of each atom of that element
+        self.element_idx = {}
+        counter = 0
+        for label, n_feat in labels:
+            self.element_idx.setdefault(label, []).append(np.arange(counter, counter + n_feat))
+            counter = counter + n_feat
+        for key in self.element_idx:
+            self.element_idx[key] = np.asarray(self.element_idx[key])
+        self.n_feat = counter
+
+    @classmethod
+    def from_estimator(cls, estimator, chunk_size=10000, dtype=None):
+        """
+        This function creates a NumpyBPNN from a trained BPNN estimator.
+
+        If the estimator has scalers, the scaling of each element is folded into the first layer of its network, so the
+        NumpyBPNN takes the unscaled features.
+
+        :estimator: BPNN object that has already been fitted
+        :chunk_size: int, default 10000
+        :dtype: None, numpy dtype, 'float16' or 'bfloat16', default None
+        :return: NumpyBPNN object
+        """
+        weights = dict(estimator.all_weights)
+        biases = dict(estimator.all_biases)
+
+        scaler = getattr(estimator, 'scaler', None)
+        if scaler is not None:
+            for key in scaler:
+                weights[key], biases[key] = _fold_scaler(weights[key], biases[key], scaler[key].mean_,
+                                                         scaler[key].scale_)
+
+        return cls(weights, biases, estimator.labels, activation='tanh', chunk_size=chunk_size, dtype=dtype)
+
+    def astype(self, dtype):
+        """
+        This function returns a copy of the network that makes the predictions with another precision.
+
+        :dtype: None, numpy dtype, 'float16' or 'bfloat16'
+        :return: NumpyBPNN object
+        """
+        return NumpyBPNN(self.__weights, self.__biases, self.labels, self.activation, self.chunk_size, dtype)
+
+    def check_precision(self, X):
+        """
+        This function compares the predictions made with the precision of this network to those made in double
+        precision with the same weights.
+
+        :X: array of shape (n_samples, n_features)
+        :return: dictionary with the largest absolute error ('max_abs_error'), the root mean square error ('rmse') and
+            the largest error relative to the range of the double precision predictions ('max_rel_error')
+        """
+        return _compare(self.predict(X), self.astype(np.float64).predict(X))
+
+    def __total_energy(self, X):
+        """
+        This function calculates the total energy of each sample as the sum of the atomic energies.
+
+        :X: numpy array of shape (n_samples, n_features)
+        :return: numpy array of shape (n_samples,)
+        """
+        activation = ACTIVATIONS[self.activation]
+        energy = np.zeros((X.shape[0],), dtype=self.dtype)
+
+        for key, idx in self.element_idx.items():
+            # Shape (n_samples, n_atoms_of_element, n_features_of_element) flattened so that each row is one atom
+            X_ele = X[:, idx].reshape((-1, idx.shape[1]))
+            atom_ene = forward(X_ele, self.weights_t[key], self.biases[key], activation, self.round_fn)
+            energy += atom_ene.reshape((X.shape[0], idx.shape[0])).sum(axis=1)
+
+        return energy
+
+    def predict(self, X):
+        """
+        This function returns the total energy predicted by the Behler-Parinello network for the samples in X.
+
+        :X: array of shape (n_samples, n_features)
+        :return: array of shape (n_samples,)
+        """
+        X = np.asarray(X)
+        n_samples = X.shape[0]
+
+        if n_samples <= self.chunk_size:
+            return self.__total_energy(X.astype(self.dtype, copy=False))
+
+        predictions = np.empty((n_samples,), dtype=self.dtype)
+        for start in range(0, n_samples, self.chunk_size):
+            chunk = X[start:start + self.chunk_size].astype(self.dtype, copy=False)
+            predictions[start:start + self.chunk_size] = self.__total_energy(chunk)
+
+        return predictions
@@ -1,7 +1,9 @@
 import numpy as np
 import ImportData
 import CoulombMatrix
+import NeighbourList
 from scipy.special import factorial
+from scipy import sparse
 
 class PartialCharges():
     """
@@ -24,12 +26,15 @@ class PartialCharges():
     :matrixX: a list of lists of atom labels and coordinates. size (n_samples, n_atoms*4)
     :matrixY: a numpy array of energy values of size (N_samples,)
     :matrixQ: a list of numpy arrays containing the partial charges of each atom. size (n_samples, n_atoms)
+    :dtype: numpy dtype of the descriptors, default np.float64. With np.float32 the descriptors take half the memory
+        and can be passed to the estimators without being converted.
 
     """
 
-    def __init__(self, matrixX, matrixY, matrixQ):
+    def __init__(self, matrixX, matrixY, matrixQ, dtype=np.float64):
 
         self.rawX = matrixX
+        self.dtype = dtype
         self.rawQ = matrixQ
         self.rawY = matrixY
 
@@ -57,9 +62,9 @@ class PartialCharges():
         self.diag_hyb_1 = np.zeros(self.n_atoms)
         self.diag_hyb_2 = np.zeros(self.n_atoms)
 
-        self.partQCM = np.zeros((self.n_samples, int(self.n_atoms * (self.n_atoms+1) * 0.5)))
-        self.partQCM24 = np.zeros((self.n_samples, int(self.n_atoms * (self.n_atoms+1) * 0.5)))
-        self.diagQ = np.zeros((self.n_samples, self.n_atoms))
+        self.partQCM = np.zeros((self.n_samples, int(self.n_atoms * (self.n_atoms+1) * 0.5)), dtype=self.dtype)
+        self.partQCM24 = np.zeros((self.n_samples, int(self.n_atoms * (self.n_atoms+1) * 0.5)), dtype=self.dtype)
+        self.diagQ = np.zeros((self.n_samples, self.n_atoms), dtype=self.dtype)
 
     def __generate_pccm(self):
         """
@@ -68,7 +73,7 @@ class PartialCharges():
 
         :return: (n_samples, n_atoms^2) numpy array
         """
-        pccm = np.zeros((self.n_samples, int(self.n_atoms * self.n_atoms)))
+        pccm = np.zeros((self.n_samples, int(self.n_atoms * self.n_atoms)), dtype=self.dtype)
 
         # This is a coulomb matrix for one particular sample in the dataset
         indivPCCM = np.zeros((self.n_atoms, self.n_atoms))
@@ -119,6 +124,35 @@ class PartialCharges():
         pccm = self.__generate_pccm()
         return pccm
 
+    def get_sparse_pccm(self, r_cut, skin=0.0):
+        """
+        This function returns the unrandomised partial charge coulomb matrix with diagonal elements :math:`q_i^2`, where
+        only the off diagonal elements of the pairs of atoms closer than r_cut are calculated and stored. The pairs are
+        found with a neighbour list, which is reused between consecutive samples when the atoms have moved less than
+        skin/2.
+
+        :r_cut: float - cut off radius
+        :skin: float, default 0.0 - skin of the neighbour list
+        :return: scipy.sparse.csr_matrix of shape (n_samples, n_atoms^2)
+        """
+        neigh_list = NeighbourList.NeighbourList(r_cut, skin=skin)
+        rows, cols, values = [], [], []
+
+        for i, (labels, coord) in enumerate(NeighbourList.frames(self.rawX)):
+            q = np.asarray(self.rawQ[i], dtype=np.float64)
+            idx_j, idx_k, dist = neigh_list.update(coord)
+            diag = np.arange(self.n_atoms)
+            off_diag = q[idx_j] * q[idx_k] / dist
+
+            cols.extend([diag * self.n_atoms + diag, idx_j * self.n_atoms + idx_k, idx_k * self.n_atoms + idx_j])
+            values.extend([q ** 2, off_diag, off_diag])
+            rows.append(np.full(self.n_atoms + 2 * len(dist), i, dtype=np.intp))
+
+        values = np.concatenate(values).astype(self.dtype)
+
+        return sparse.csr_matrix((values, (np.concatenate(rows), np.concatenate(cols))),
+                                 shape=(self.n_samples, self.n_atoms * self.n_atoms))
+
     def generatePCCM(self, numRep=5):
         """
         This function generates the partially randomised partial charge Coulomb matrix. The diagonal are :math:`q_i^2`
@@ -164,7 +198,7 @@ class PartialCharges():
             print "Error: you cannot generate less than 1 RSCM per sample. Enter an integer value > 1."
 
         counter = 0
-        ranSort = np.zeros((self.n_samples * numRep, int(self.n_atoms * (self.n_atoms+1) * 0.5)))
+        ranSort = np.zeros((self.n_samples * numRep, int(self.n_atoms * (self.n_atoms+1) * 0.5)), dtype=self.dtype)
         y_bigdata = np.zeros((self.n_samples * numRep,))
 
         for i in range(self.n_samples):
@@ -204,7 +238,7 @@ class PartialCharges():
         :return: numpy array of shape (n_atoms*(n_atoms+1)/2, )
         """
         size = int(self.n_atoms * (self.n_atoms+1) * 0.5)
-        temp = np.zeros((size,))
+        temp = np.zeros((size,), dtype=self.dtype)
         counter = 0
 
         for i in range(self.n_atoms):
@@ -273,7 +307,7 @@ class PartialCharges():
                 PRCM.append(self.__trimAndFlat(currentMat))
 
         # Turn PRCM into a numpy array of size (n_samples*min(n_perm, numRep), n_features)
-        PRCM = np.asarray(PRCM)
+        PRCM = np.asarray(PRCM, dtype=self.dtype)
 
         # Modify the shape of y
         y_big = np.asarray(np.repeat(y_data,min(n_perm, numRep)))
@@ -0,0 +1,355 @@
+"""
+This module hosts one trained model in a server that several processes (for example the walkers of a molecular
+dynamics simulation) can send their configurations to, so that only one copy of the model is loaded and the predictions
+of the different processes are made together.
+
+The server listens on a Unix socket (by default one in a new temporary directory, or the path given as the address) or
+on a TCP port (if the address is a tuple (host, port)). Each client sends one configuration at a time and waits for its
+prediction. The requests that arrive within max_latency seconds of each other are grouped into a micro-batch of at most
+max_batch_size configurations, which is passed to the model in one call. The first request of a batch therefore never
+waits more than max_latency seconds before the model is called.
+
+Two kinds of requests can be made:
+
+1. 'predict': the descriptor of one configuration (array of shape (n_features,)). The server returns the energy.
+2. 'predict_forces': the coordinates of one configuration (array of shape (n_atoms, 3)). The server returns the energy
+   and the forces. This needs a model that can calculate the forces: an MLPRegFlow or BPNN estimator together with the
+   TensorFlow function that calculates the descriptor, or an Export.ExportedModel exported with the descriptor.
+
+BPNN.predict and BPNN.predict_forces build a new graph at each call, which would take longer than the predictions of a
+micro-batch. A BPNN estimator is therefore converted to a NumpyNN.NumpyBPNN for the 'predict' requests, and the graph
+that calculates the forces is built the first time it is needed and then kept with its session.
+
+The messages are pickled by multiprocessing.connection, and unpickling a message can run arbitrary code. A server
+listening on a TCP port can be reached by any user of the machine (or of the network), so it must be given an authkey,
+for example os.urandom(32), which is then handed to the clients.
+"""
+
+from __future__ import print_function
+import threading
+import time
+from multiprocessing.connection import Listener, Client
+import numpy as np
+import NumpyNN
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Number of connections that can wait to be accepted
+_BACKLOG = 128
+
+
+class PredictionServer():
+    """
+    This class is a server that makes predictions with one model for many clients, in micro-batches.
+
+    :model: MLPRegFlow, BPNN, NumpyNN.NumpyMLP, NumpyNN.NumpyBPNN or Export.ExportedModel object that has already been
+        fitted. A BPNN estimator is converted to a NumpyNN.NumpyBPNN, which is stored in the attribute model.
+    :address: None, string or tuple, default None - path of the Unix socket or (host, port) of the TCP socket. If None,
+        a Unix socket is made in a new temporary directory (a named pipe on Windows). If the port is 0, a free port is
+        chosen. The address can be read from the attribute address once the server is started.
+    :descriptor: function or None, default None - function that takes a tf.Tensor of coordinates of shape
+        (n_samples, n_atoms, 3) and returns the descriptor (for example the function tf_descriptor of a CoulombMatrix
+        object). It is needed for the 'predict_forces' requests when the model is an MLPRegFlow or BPNN estimator.
+    :max_batch_size: int, default 64 - largest number of configurations predicted together
+    :max_latency: float, default 0.005 - longest time in seconds that the first request of a batch waits for other
+        requests
+    :authkey: bytes or None, default None - key that the clients need to connect. It is required if the server listens
+        on a TCP port.
+    """
+
+    def __init__(self, model, address=None, descriptor=None, max_batch_size=64, max_latency=0.005, authkey=None):
+
+        if isinstance(address, tuple) and not authkey:
+            raise ValueError("A server listening on a TCP port needs an authkey, for example os.urandom(32).")
+
+        # BPNN estimator that the NumpyBPNN was made from, used to build the graph of the forces
+        self.__estimator = None
+        self.__forces_graph = None
+        if isinstance(getattr(model, 'all_weights', None), dict) and hasattr(model, 'inference_graph'):
+            self.__estimator = model
+            model = NumpyNN.NumpyBPNN.from_estimator(model)
+
+        self.model = model
+        self.address = address
+        self.descriptor = descriptor
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.authkey = authkey
+
+        # Number of batches and of requests handled so far
+        self.n_batches = 0
+        self.n_requests = 0
+
+        self.__requests = queue.Queue()
+        self.__stop = threading.Event()
+        # Held while a request is put in the queue and while the server is stopped, so that no request is put in the
+        # queue after it has been emptied
+        self.__lock = threading.Lock()
+        self.__listener = None
+        self.__threads = []
+
+    def start(self):
+        """
+        This function starts the server in background threads and returns once it is listening.
+
+        :return: self
+        """
+        # The default backlog of the listener is 1, which makes the clients that connect at the same time wait
+        self.__listener = Listener(self.address, backlog=_BACKLOG, authkey=self.authkey)
+        self.address = self.__listener.address
+        self.__stop.clear()
+
+        self.__threads = [threading.Thread(target=self.__accept), threading.Thread(target=self.__batch_loop)]
+        for thread in self.__threads:
+            thread.daemon = True
+            thread.start()
+
+        return self
+
+    def serve_forever(self):
+        """
+        This function starts the server and blocks until shutdown is called (from another thread) or the process is
+        interrupted.
+        """
+        self.start()
+        try:
+            while not self.__stop.is_set():
+                self.__stop.wait(1.0)
+        except KeyboardInterrupt:
+            self.shutdown()
+
+    def shutdown(self):
+        """
+        This function stops the server. The requests that are waiting are answered with an error.
+        """
+        with self.__lock:
+            if self.__stop.is_set():
+                return
+            self.__stop.set()
+
+        # accept() doesn't return when the listener is closed, so a last connection is made to wake it up
+        try:
+            Client(self.address, authkey=self.authkey).close()
+        except Exception:
+            pass
+        self.__listener.close()
+
+        for thread in self.__threads:
+            thread.join()
+
+        if self.__forces_graph is not None:
+            self.__forces_graph['session'].close()
+            self.__forces_graph = None
+
+    def __accept(self):
+        """
+        This function accepts the connections of the clients and starts a thread for each of them.
+        """
+        while not self.__stop.is_set():
+            try:
+                conn = self.__listener.accept()
+            except Exception:
+                continue
+
+            if self.__stop.is_set():
+                conn.close()
+                break
+
+            thread = threading.Thread(target=self.__handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def __handle(self, conn):
+        """
+        This function receives the requests of one client, puts them in the queue of the server and sends back the
+        replies. Each request is a tuple with the kind of request and an array.
+
+        :conn: multiprocessing.connection.Connection
+        """
+        try:
+            while not self.__stop.is_set():
+                try:
+                    kind, data = conn.recv()
+                except EOFError:
+                    break
+
+                reply = queue.Queue(maxsize=1)
+                with self.__lock:
+                    stopped = self.__stop.is_set()
+                    if not stopped:
+                        self.__requests.put((kind, np.asarray(data, dtype=np.float32), reply))
+                if stopped:
+                    conn.send(('error', "The server has been shut down."))
+                    break
+
+                conn.send(reply.get())
+        finally:
+            conn.close()
+
+    def __batch_loop(self):
+        """
+        This function takes the requests from the queue and groups them into micro-batches: after the first request
+        of a batch arrives, the following ones are added until the batch is full or max_latency seconds have passed.
+        """
+        while not self.__stop.is_set():
+            try:
+                batch = [self.__requests.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+
+            deadline = time.time() + self.max_latency
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.__requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.__run_batch(batch)
+
+        # The requests that are left are answered with an error, so that no client waits forever. No request can be
+        # added once the stop flag is set, so the queue stays empty after this
+        while True:
+            try:
+                kind, data, reply = self.__requests.get_nowait()
+            except queue.Empty:
+                break
+            reply.put(('error', "The server has been shut down."))
+
+    def __run_batch(self, batch):
+        """
+        This function makes the predictions for a batch of requests. The requests of the same kind and with data of
+        the same shape are stacked and passed to the model together.
+
+        :batch: list of tuples with the kind of request, the data and the queue where the reply is put
+        """
+        groups = {}
+        for request in batch:
+            groups.setdefault((request[0], request[1].shape), []).append(request)
+
+        for (kind, shape), requests in groups.items():
+            data = np.stack([request[1] for request in requests])
+            try:
+                if kind == 'predict':
+                    energies = np.reshape(self.model.predict(data), (len(requests), -1))
+                    replies = [('ok', energy) for energy in energies]
+                elif kind == 'predict_forces':
+                    energies, forces = self.__predict_forces(data)
+                    energies = np.reshape(energies, (len(requests), -1))
+                    replies = [('ok', energy, force) for energy, force in zip(energies, forces)]
+                else:
+                    raise ValueError("Unknown request %s." % kind)
+            except Exception as error:
+                replies = [('error', "%s: %s" % (type(error).__name__, error))] * len(requests)
+
+            for request, reply in zip(requests, replies):
+                request[2].put(reply)
+
+            self.n_batches += 1
+            self.n_requests += len(requests)
+
+    def __predict_forces(self, coord):
+        """
+        This function calculates the energies and the forces of a batch of configurations with the model.
+
+        :coord: numpy array of shape (n_samples, n_atoms, 3)
+        :return: the energies and numpy array of shape (n_samples, n_atoms, 3) with the forces
+        """
+        if self.descriptor is not None and self.__estimator is not None:
+            return self.__bpnn_forces(coord)
+        if self.descriptor is not None:
+            return self.model.predict_forces(coord, self.descriptor)
+        if 'energy_forces' in getattr(self.model, 'signatures', {}):
+            return self.model.predict_forces(coord)
+
+        raise ValueError("The server can't calculate the forces: give it the descriptor function or a model exported "
+                         "with the descriptor.")
+
+    def __bpnn_forces(self, coord):
+        """
+        This function calculates the energies and the forces of a batch of configurations with the BPNN estimator. The
+        graph is built with the weights as constants the first time (or when the number of atoms changes) and is then
+        reused with the same session.
+
+        :coord: numpy array of shape (n_samples, n_atoms, 3)
+        :return: the energies and numpy array of shape (n_samples, n_atoms, 3) with the forces
+        """
+        import tensorflow as tf
+        import TFSession
+
+        if self.__forces_graph is None or self.__forces_graph['n_atoms'] != coord.shape[1]:
+            if self.__forces_graph is not None:
+                self.__forces_graph['session'].close()
+
+            graph = tf.Graph()
+            with graph.as_default():
+                coord_tf = tf.placeholder(tf.float32, [None, coord.shape[1], 3])
+                energy, forces = self.__estimator.forces_graph(coord_tf, self.descriptor)
+
+            session = TFSession.new_session(graph, self.__estimator.intra_op_threads,
+                                            self.__estimator.inter_op_threads)
+            self.__forces_graph = {'n_atoms': coord.shape[1], 'coord': coord_tf, 'energy': energy, 'forces': forces,
+                                   'session': session}
+
+        return self.__forces_graph['session'].run([self.__forces_graph['energy'], self.__forces_graph['forces']],
+                                                  feed_dict={self.__forces_graph['coord']: coord})
+
+
+class PredictionClient():
+    """
+    This class connects to a PredictionServer and sends it one configuration at a time.
+
+    :address: string or tuple - address of the server (its attribute address)
+    :authkey: bytes or None, default None - the key of the server
+    """
+
+    def __init__(self, address, authkey=None):
+
+        self.conn = Client(address, authkey=authkey)
+
+    def __request(self, kind, data):
+        """
+        This function sends a request to the server and waits for the reply.
+
+        :kind: string, 'predict' or 'predict_forces'
+        :data: numpy array
+        :return: the reply without its status
+        """
+        self.conn.send((kind, np.asarray(data, dtype=np.float32)))
+        reply = self.conn.recv()
+
+        if reply[0] == 'error':
+            raise RuntimeError("The server could not make the prediction: %s" % reply[1])
+
+        return reply[1:]
+
+    def predict(self, x):
+        """
+        This function returns the energy predicted for one configuration from its descriptor.
+
+        :x: array of shape (n_features,)
+        :return: numpy array of shape (n_output,)
+        """
+        return self.__request('predict', x)[0]
+
+    def predict_forces(self, coord):
+        """
+        This function returns the energy and the forces predicted for one configuration from its coordinates.
+
+        :coord: array of shape (n_atoms, 3)
+        :return: numpy array of shape (n_output,) with the energy and numpy array of shape (n_atoms, 3) with the forces
+        """
+        energy, forces = self.__request('predict_forces', coord)
+
+        return energy, forces
+
+    def close(self):
+        """
+        This function closes the connection to the server.
+        """
+        self.conn.close()
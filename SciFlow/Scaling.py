@@ -0,0 +1,98 @@
+"""
+This module contains a scaler that standardises the features of the descriptors (removes the mean and divides by the
+standard deviation of each feature). The Coulomb matrix in particular has features with very different magnitudes
+(the diagonal elements :math:`0.5 Z^{2.4}` are much larger than the off diagonal ones) and the sigmoid networks train
+much faster on standardised features.
+
+The mean and the variance are accumulated chunk by chunk as the descriptors are generated, using the formula of Chan
+et al. to merge the statistics of each chunk with those of the previous ones, so no separate pass over the data is
+needed. The fitted scaler can then be given to MLPRegFlow, which applies it inside the TensorFlow graph, so the scaled
+data is never stored.
+"""
+
+import numpy as np
+
+
+class StreamingScaler():
+    """
+    This class calculates the mean and the standard deviation of each feature of a data set that is seen in chunks.
+
+    After fitting, the attributes are:
+
+    :n_samples_seen_: int - number of samples seen
+    :mean_: numpy array of shape (n_features,)
+    :var_: numpy array of shape (n_features,) - the (biased) variance of each feature
+    :scale_: numpy array of shape (n_features,) - the standard deviation of each feature, or 1 for the features
+        that are constant
+    """
+
+    def __init__(self):
+
+        self.n_samples_seen_ = 0
+        self.mean_ = None
+        self.var_ = None
+        self.scale_ = None
+        self.__m2 = None
+
+    def partial_fit(self, X):
+        """
+        This function updates the mean and the variance with a new chunk of samples.
+
+        :X: array of shape (n_samples_in_chunk, n_features)
+        :return: self
+        """
+        X = np.asarray(X)
+        n_chunk = X.shape[0]
+        if n_chunk == 0:
+            return self
+
+        # The statistics are always accumulated in double precision
+        mean_chunk = np.mean(X, axis=0, dtype=np.float64)
+        m2_chunk = np.sum((X - mean_chunk) ** 2, axis=0, dtype=np.float64)
+
+        if self.n_samples_seen_ == 0:
+            self.mean_ = mean_chunk
+            self.__m2 = m2_chunk
+        else:
+            n_total = self.n_samples_seen_ + n_chunk
+            delta = mean_chunk - self.mean_
+            self.mean_ = self.mean_ + delta * n_chunk / float(n_total)
+            self.__m2 = self.__m2 + m2_chunk + delta ** 2 * self.n_samples_seen_ * n_chunk / float(n_total)
+
+        self.n_samples_seen_ += n_chunk
+        self.var_ = self.__m2 / self.n_samples_seen_
+        self.scale_ = np.sqrt(self.var_)
+        self.scale_[self.scale_ == 0.0] = 1.0
+
+        return self
+
+    def fit(self, X, chunk_size=10000):
+        """
+        This function calculates the mean and the variance of X from scratch, reading it in chunks (so X can be a numpy
+        memmap).
+
+        :X: array of shape (n_samples, n_features)
+        :chunk_size: int, default 10000
+        :return: self
+        """
+        self.__init__()
+
+        for start in range(0, X.shape[0], chunk_size):
+            self.partial_fit(X[start:start + chunk_size])
+
+        return self
+
+    def transform(self, X):
+        """
+        This function standardises X. It makes a new array, so when training or making predictions with MLPRegFlow it
+        is better to give the scaler to the estimator instead.
+
+        :X: array of shape (n_samples, n_features)
+        :return: array of shape (n_samples, n_features)
+        """
+        if self.mean_ is None:
+            raise AttributeError("The scaler has not been fitted yet.")
+
+        X = np.asarray(X)
+
+        return ((X - self.mean_) / self.scale_).astype(X.dtype, copy=False)
@@ -0,0 +1,249 @@
+"""
+This module saves trained MLPRegFlow and BPNN estimators in a compact format that can be loaded by the numpy inference
+engine of NumpyNN without importing TensorFlow.
+
+A saved model is a directory with two files:
+
+1. model.json: the type of network, the activation function, the atom labels (for BPNN), the description of the
+   descriptor used to make the features (its class, its hyperparameters and, for a Coulomb matrix, the variant of the
+   matrix and its arguments), and the dtype, shape and position of each array.
+2. arrays.npy: a single contiguous block of bytes with all the arrays (the transposed weights and the biases of each
+   layer and, if the estimator has them, the mean and the standard deviation of the scaler, or of the scaler of each
+   element for BPNN). Each array starts at an offset that is a multiple of 64 bytes.
+
+When a model is loaded, arrays.npy is opened as a numpy memmap and the arrays are views of it, so loading takes a few
+milliseconds whatever the size of the network and the weights are only read from disk when they are used. Nothing of
+the training (cost history, checkpoints, plotting state) is saved.
+"""
+
+import json
+import os
+import numpy as np
+import NumpyNN
+
+FORMAT_VERSION = 1
+
+# Offsets of the arrays in arrays.npy are multiples of this number of bytes
+_ALIGNMENT = 64
+
+# Hyperparameters of each descriptor class that are saved by descriptor_spec
+_DESCRIPTOR_PARAMS = {
+    'CoulombMatrix': ('n_atoms', 'r_cut', 'dtype'),
+    'PartialCharges': ('n_atoms', 'dtype'),
+    'tewDescriptor': ('n_atoms', 'dtype'),
+    'SymmetryFunctions': ('atom_labels', 'elements', 'r_cut', 'eta_rad', 'r_s', 'eta_ang', 'zeta', 'lambdas', 'dtype'),
+}
+
+# Functions of each descriptor class that make different features from the same object. For these classes the function
+# that was used (the variant) has to be saved as well.
+_DESCRIPTOR_VARIANTS = {
+    'CoulombMatrix': ('getCM', 'generateES', 'generateSCM', 'generateRSCM', 'generatePRCM', 'generatePermutedCM',
+                      'generateTrimmedCM'),
+}
+
+
+def _to_json(value):
+    """
+    This function converts the numpy types in the hyperparameters of a descriptor to types that can be written to json.
+
+    :value: int, float, string, dtype, list, tuple or numpy array
+    :return: object that can be written to json
+    """
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (type, np.dtype)):
+        return np.dtype(value).name
+
+    return value
+
+
+def descriptor_spec(descriptor, variant=None, variant_args=None):
+    """
+    This function returns a description of the descriptor used to make the features of a model, which can be saved
+    with the model so that the same features can be made when it is loaded.
+
+    A CoulombMatrix object can make different features (for example the trimmed, the sorted or the randomly permuted
+    matrices), so for it the name of the function that made the features has to be given as the variant, together with
+    the arguments it was called with (except the energies).
+
+    :descriptor: CoulombMatrix, PartialCharges, tewDescriptor or SymmetryFunctions object, or a dictionary (returned
+        unchanged)
+    :variant: string or None, default None - name of the function of the descriptor that made the features, for example
+        'generateTrimmedCM', 'generateSCM' or 'generatePermutedCM'
+    :variant_args: dictionary or None, default None - arguments of that function, for example {'n_perm': 20,
+        'kind': 'PRCM'}
+    :return: dictionary with the name of the descriptor class, its hyperparameters and, if given, the variant and its
+        arguments
+    """
+    if isinstance(descriptor, dict):
+        return descriptor
+
+    name = type(descriptor).__name__
+    if name not in _DESCRIPTOR_PARAMS:
+        raise ValueError("Unknown descriptor %s, pass a dictionary that describes it instead." % name)
+
+    if name in _DESCRIPTOR_VARIANTS and variant not in _DESCRIPTOR_VARIANTS[name]:
+        raise ValueError("The variant of a %s should be one of %s, got %s."
+                         % (name, ", ".join(_DESCRIPTOR_VARIANTS[name]), variant))
+    if variant is not None and not hasattr(descriptor, variant):
+        raise ValueError("The %s has no function %s." % (name, variant))
+
+    spec = {'name': name}
+    for param in _DESCRIPTOR_PARAMS[name]:
+        spec[param] = _to_json(getattr(descriptor, param))
+
+    if variant is not None:
+        spec['variant'] = variant
+        spec['variant_args'] = dict((key, _to_json(value)) for key, value in (variant_args or {}).items())
+
+    return spec
+
+
+def save_model(estimator, path, descriptor=None, variant=None, variant_args=None):
+    """
+    This function saves a trained MLPRegFlow or BPNN estimator to the directory path (which is created if it doesn't
+    exist).
+
+    :estimator: MLPRegFlow or BPNN object that has already been fitted
+    :path: string - directory where the model is saved
+    :descriptor: None, dictionary or descriptor object (see descriptor_spec), default None - description of the
+        descriptor used to make the features
+    :variant: string or None, default None - function of the descriptor that made the features (needed for a
+        CoulombMatrix, see descriptor_spec)
+    :variant_args: dictionary or None, default None - arguments of that function
+    """
+    if not hasattr(estimator, 'all_weights'):
+        raise AttributeError("The estimator has not been fitted yet.")
+
+    arrays = []
+    if isinstance(estimator.all_weights, dict):
+        model = {'model': 'BPNN', 'activation': 'tanh',
+                 'labels': [[label, int(n_feat)] for label, n_feat in estimator.labels]}
+        for key in sorted(estimator.all_weights.keys()):
+            for ii, (w, b) in enumerate(zip(estimator.all_weights[key], estimator.all_biases[key])):
+                arrays.append(('weights_t/%s/%d' % (key, ii), np.asarray(w).T))
+                arrays.append(('biases/%s/%d' % (key, ii), np.asarray(b)))
+    else:
+        model = {'model': 'MLPRegFlow', 'activation': 'sigmoid'}
+        for ii, (w, b) in enumerate(zip(estimator.all_weights, estimator.all_biases)):
+            arrays.append(('weights_t/%d' % ii, np.asarray(w).T))
+            arrays.append(('biases/%d' % ii, np.asarray(b)))
+
+    # BPNN has one scaler for each element
+    scaler = getattr(estimator, 'scaler', None)
+    model['scaler'] = scaler is not None
+    if isinstance(scaler, dict):
+        for key in sorted(scaler.keys()):
+            arrays.append(('scaler/%s/mean' % key, np.asarray(scaler[key].mean_)))
+            arrays.append(('scaler/%s/scale' % key, np.asarray(scaler[key].scale_)))
+    elif scaler is not None:
+        arrays.append(('scaler/mean', np.asarray(scaler.mean_)))
+        arrays.append(('scaler/scale', np.asarray(scaler.scale_)))
+
+    model['format_version'] = FORMAT_VERSION
+    if descriptor is not None:
+        model['descriptor'] = descriptor_spec(descriptor, variant=variant, variant_args=variant_args)
+    else:
+        model['descriptor'] = None
+
+    # Position of each array in the block of bytes
+    model['arrays'] = {}
+    offset = 0
+    for name, array in arrays:
+        offset = -(-offset // _ALIGNMENT) * _ALIGNMENT
+        model['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += array.nbytes
+
+    block = np.zeros((offset,), dtype=np.uint8)
+    for name, array in arrays:
+        start = model['arrays'][name]['offset']
+        block[start:start + array.nbytes] = np.ascontiguousarray(array).view(np.uint8).ravel()
+
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    np.save(os.path.join(path, 'arrays.npy'), block)
+    with open(os.path.join(path, 'model.json'), 'w') as json_file:
+        json.dump(model, json_file, indent=1, sort_keys=True)
+
+
+def _read_arrays(path, layout, mmap):
+    """
+    This function reads the arrays of a saved model.
+
+    :path: string - directory of the model
+    :layout: dictionary with the dtype, the shape and the offset of each array
+    :mmap: bool - whether arrays.npy is opened as a memmap or read into memory
+    :return: dictionary where the keys are the names of the arrays and the values are numpy arrays
+    """
+    block = np.load(os.path.join(path, 'arrays.npy'), mmap_mode='r' if mmap else None)
+
+    arrays = {}
+    for name, entry in layout.items():
+        dtype = np.dtype(entry['dtype'])
+        n_bytes = int(np.prod(entry['shape'])) * dtype.itemsize
+        arrays[name] = block[entry['offset']:entry['offset'] + n_bytes].view(dtype).reshape(entry['shape'])
+
+    return arrays
+
+
+def load_model(path, mmap=True, chunk_size=10000, dtype=None):
+    """
+    This function loads a model saved with save_model as a NumpyMLP or NumpyBPNN object. The description of the
+    descriptor that was saved with the model is stored in the attribute descriptor of the returned object.
+
+    If the model has a scaler (or a scaler for each element), it is folded into the first layer (of the network of each
+    element), so the returned network takes the unscaled features.
+
+    :path: string - directory of the model
+    :mmap: bool, default True - whether the weights are memory mapped instead of read into memory
+    :chunk_size: int, default 10000
+    :dtype: None, numpy dtype, 'float16' or 'bfloat16', default None - precision of the predictions. If None, the dtype
+        of the saved weights is used.
+    :return: NumpyMLP or NumpyBPNN object
+    """
+    with open(os.path.join(path, 'model.json')) as json_file:
+        model = json.load(json_file)
+
+    if model['format_version'] > FORMAT_VERSION:
+        raise ValueError("The model was saved with a newer version of the format (%d)." % model['format_version'])
+
+    arrays = _read_arrays(path, model['arrays'], mmap)
+
+    if model['model'] == 'BPNN':
+        weights = {}
+        biases = {}
+        for name in arrays:
+            kind, key, ii = name.split('/')
+            if kind == 'weights_t':
+                weights.setdefault(key, {})[int(ii)] = arrays[name].T
+            elif kind == 'biases':
+                biases.setdefault(key, {})[int(ii)] = arrays[name]
+        weights = dict((key, [layers[ii] for ii in sorted(layers)]) for key, layers in weights.items())
+        biases = dict((key, [layers[ii] for ii in sorted(layers)]) for key, layers in biases.items())
+        labels = [(label, n_feat) for label, n_feat in model['labels']]
+
+        if model['scaler']:
+            for key in weights:
+                if 'scaler/%s/mean' % key in arrays:
+                    weights[key], biases[key] = NumpyNN._fold_scaler(weights[key], biases[key],
+                                                                     arrays['scaler/%s/mean' % key],
+                                                                     arrays['scaler/%s/scale' % key])
+
+        network = NumpyNN.NumpyBPNN(weights, biases, labels, activation=model['activation'], chunk_size=chunk_size,
+                                    dtype=dtype)
+    else:
+        n_layers = len([name for name in arrays if name.startswith('weights_t/')])
+        weights = [arrays['weights_t/%d' % ii].T for ii in range(n_layers)]
+        biases = [arrays['biases/%d' % ii] for ii in range(n_layers)]
+
+        if model['scaler']:
+            weights, biases = NumpyNN._fold_scaler(weights, biases, arrays['scaler/mean'], arrays['scaler/scale'])
+
+        network = NumpyNN.NumpyMLP(weights, biases, activation=model['activation'], chunk_size=chunk_size,
+                                   dtype=dtype)
+
+    network.descriptor = model['descriptor']
+
+    return network
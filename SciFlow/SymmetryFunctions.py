@@ -0,0 +1,301 @@
+"""
+This module generates the atom centred symmetry functions of Behler and Parrinello, which are the descriptors used by
+the Behler-Parinello neural network in the BPNN module. The symmetry functions are described in this
+`paper <http://aip.scitation.org/doi/10.1063/1.3553717>`_.
+
+For each atom *i*, there are radial symmetry functions for each element *e* of the system:
+
+:math:`G^2_i = \\sum_{j \\in e} e^{-\\eta (R_{ij} - R_s)^2} f_c(R_{ij})`
+
+and angular symmetry functions for each pair of elements *(e1, e2)*:
+
+:math:`G^4_i = 2^{1-\\zeta} \\sum_{j \\in e1, k \\in e2} (1 + \\lambda \\cos \\theta_{ijk})^\\zeta
+e^{-\\eta (R_{ij}^2 + R_{ik}^2 + R_{jk}^2)} f_c(R_{ij}) f_c(R_{ik}) f_c(R_{jk})`
+
+where :math:`f_c(R) = 0.5 (\\cos(\\pi R / R_c) + 1)` for :math:`R < R_c` and 0 otherwise.
+"""
+
+import numpy as np
+from multiprocessing import Pool
+from NeighbourList import NeighbourList
+
+
+class SymmetryFunctions():
+    """
+    This class generates the symmetry functions for M configurations of N atoms. The descriptors of all the atoms of
+    a configuration are concatenated in one line, in the same order as the atoms in the configuration, so that they can
+    be passed directly to BPNN with the labels returned by get_labels().
+
+    The calculation is done with numpy on batches of configurations, using neighbour lists so that only the pairs and
+    triplets of atoms inside the cut off radius are considered. For large trajectories, the configurations are
+    split in chunks of chunk_size samples that can be processed in parallel by n_jobs processes.
+
+    :matrixX: list of lists, where each of the inner lists represents a sample configuration. An example is shown below: [ [ 'C', 0.1, 0.3, 0.5, 'H', 0.0, 0.5 1.0, 'H', 0.0, -0.5, -1.0, ....], [...], ... ].
+    :r_cut: float, default 5.0 - cut off radius
+    :eta_rad: list of floats - widths of the radial symmetry functions
+    :r_s: list of floats - centres of the radial symmetry functions
+    :eta_ang: list of floats - widths of the angular symmetry functions
+    :zeta: list of floats - angular resolution of the angular symmetry functions
+    :lambdas: list of floats (either 1.0 or -1.0) - position of the maximum of the angular symmetry functions
+    :dtype: numpy dtype of the descriptors, default np.float64. The symmetry functions are always calculated in double
+        precision and then stored with this dtype.
+    """
+
+    def __init__(self, matrixX, r_cut=5.0, eta_rad=(0.05, 0.5, 2.0), r_s=(0.0,), eta_ang=(0.005,), zeta=(1.0, 4.0),
+                 lambdas=(-1.0, 1.0), dtype=np.float64):
+
+        self.r_cut = r_cut
+        self.eta_rad = eta_rad
+        self.r_s = r_s
+        self.eta_ang = eta_ang
+        self.zeta = zeta
+        self.lambdas = lambdas
+        self.dtype = dtype
+
+        self.n_atoms = int(len(matrixX[0]) / 4)
+        self.n_samples = len(matrixX)
+
+        # The atom labels are taken from the first configuration, all the configurations have the atoms in the same order
+        self.atom_labels = [matrixX[0][4 * i] for i in range(self.n_atoms)]
+        self.elements = sorted(set(self.atom_labels))
+        self.element_pairs = [(self.elements[i], self.elements[j]) for i in range(len(self.elements))
+                              for j in range(i, len(self.elements))]
+
+        self.coord = np.zeros((self.n_samples, self.n_atoms, 3))
+        for i in range(self.n_samples):
+            for j in range(self.n_atoms):
+                self.coord[i, j, :] = matrixX[i][4 * j + 1:4 * j + 4]
+
+        self.n_rad = len(self.eta_rad) * len(self.r_s)
+        self.n_ang = len(self.eta_ang) * len(self.zeta) * len(self.lambdas)
+        self.n_feat = self.n_rad * len(self.elements) + self.n_ang * len(self.element_pairs)
+
+    def get_labels(self):
+        """
+        This function returns the labels needed by BPNN to know which features belong to which atom.
+
+        :return: list of tuples with the atom label and the number of features of that atom, for example
+            [('C', 24), ('H', 24), ...]
+        """
+        return [(label, self.n_feat) for label in self.atom_labels]
+
+    def generate(self, chunk_size=1000, n_jobs=1, scaler=None):
+        """
+        This function calculates the symmetry functions for all the configurations.
+
+        :chunk_size: int, default 1000 - number of configurations processed at once
+        :n_jobs: int, default 1 - number of processes used
+        :scaler: Scaling.StreamingScaler, dictionary or None, default None - if given, it is updated with each chunk as
+            soon as it has been calculated. A StreamingScaler is fitted on the full rows (for MLPRegFlow). A dictionary
+            where the key is the atom label and the value is a StreamingScaler (as used by BPNN) fits each scaler on
+            the features of the atoms of that element.
+        :return: numpy array of shape (n_samples, n_atoms * n_features)
+        """
+        params = self.__params()
+        starts = range(0, self.n_samples, chunk_size)
+        chunks = [(self.coord[start:start + chunk_size], params) for start in starts]
+
+        if n_jobs > 1:
+            pool = Pool(n_jobs)
+            try:
+                results = pool.imap(_symmetry_functions_chunk, chunks)
+                self.sym_funct = self.__collect(starts, results, scaler)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            self.sym_funct = self.__collect(starts, (_symmetry_functions_chunk(chunk) for chunk in chunks), scaler)
+
+        return self.sym_funct
+
+    def __collect(self, starts, results, scaler):
+        """
+        This function writes the symmetry functions of each chunk into a preallocated array with the right dtype, so
+        that the full descriptor is never stored in double precision.
+
+        :starts: list of the index of the first sample of each chunk
+        :results: iterable of numpy arrays of shape (n_samples_in_chunk, n_atoms, n_features)
+        :scaler: Scaling.StreamingScaler, dictionary of Scaling.StreamingScaler or None
+        :return: numpy array of shape (n_samples, n_atoms * n_features)
+        """
+        if isinstance(scaler, dict):
+            element_idx = dict((label, [i for i, atom in enumerate(self.atom_labels) if atom == label])
+                               for label in scaler)
+        sym_funct = np.empty((self.n_samples, self.n_atoms * self.n_feat), dtype=self.dtype)
+
+        for start, result in zip(starts, results):
+            sym_funct[start:start + result.shape[0]] = result.reshape((result.shape[0], -1))
+            if isinstance(scaler, dict):
+                for label, element_scaler in scaler.items():
+                    element_scaler.partial_fit(result[:, element_idx[label], :].reshape((-1, self.n_feat)))
+            elif scaler is not None:
+                scaler.partial_fit(sym_funct[start:start + result.shape[0]])
+
+        return sym_funct
+
+    def tf_descriptor(self, coord):
+        """
+        This function builds the symmetry functions as a TensorFlow graph, so that they can be differentiated with
+        respect to the coordinates of the atoms (for example to calculate the forces with BPNN.predict_forces). The
+        features are in the same order as the ones returned by generate(). TensorFlow is only imported when this
+        function is called.
+
+        :coord: tf.Tensor of shape (n_samples, n_atoms, 3)
+        :return: tf.Tensor of shape (n_samples, n_atoms * n_features)
+        """
+        import tensorflow as tf
+
+        params = self.__params()
+        n_atoms = self.n_atoms
+        eye = tf.constant(np.eye(n_atoms), dtype=coord.dtype)
+
+        # The identity is added to the squared distances so that the gradient of the distance of an atom from itself
+        # is finite. These terms are then removed by the cut off function.
+        R_sq = tf.reduce_sum((coord[:, :, tf.newaxis, :] - coord[:, tf.newaxis, :, :]) ** 2, axis=-1) + eye
+        R = tf.sqrt(R_sq)
+        fc = tf.where(R < self.r_cut, 0.5 * (tf.cos(np.pi * R / self.r_cut) + 1.0), tf.zeros_like(R)) * (1.0 - eye)
+
+        element_masks = tf.constant(params['element_masks'].T, dtype=coord.dtype)
+        radial = []
+        for eta, r_s in params['rad']:
+            g_ij = tf.exp(-eta * (R - r_s) ** 2) * fc
+            radial.append(tf.tensordot(g_ij, element_masks, axes=[[2], [0]]))
+        radial = tf.reshape(tf.stack(radial, axis=-1), [-1, n_atoms, self.n_rad * len(self.elements)])
+
+        cos_theta = (R_sq[:, :, :, tf.newaxis] + R_sq[:, :, tf.newaxis, :] - R_sq[:, tf.newaxis, :, :]) / \
+                    (2.0 * R[:, :, :, tf.newaxis] * R[:, :, tf.newaxis, :])
+        # Only the terms that are removed by the cut off can be outside [-1, 1]
+        cos_theta = tf.clip_by_value(cos_theta, -1.0, 1.0)
+        fc_ijk = fc[:, :, :, tf.newaxis] * fc[:, :, tf.newaxis, :] * fc[:, tf.newaxis, :, :]
+        R_sq_ijk = R_sq[:, :, :, tf.newaxis] + R_sq[:, :, tf.newaxis, :] + R_sq[:, tf.newaxis, :, :]
+
+        pair_masks = tf.constant(params['pair_masks'].reshape((len(self.element_pairs), -1)).T, dtype=coord.dtype)
+        angular = []
+        for eta, zeta, lam in params['ang']:
+            g_ijk = 2.0 ** (1.0 - zeta) * (1.0 + lam * cos_theta) ** zeta * tf.exp(-eta * R_sq_ijk) * fc_ijk
+            g_ijk = tf.reshape(g_ijk, [-1, n_atoms, n_atoms * n_atoms])
+            angular.append(0.5 * tf.tensordot(g_ijk, pair_masks, axes=[[2], [0]]))
+        angular = tf.reshape(tf.stack(angular, axis=-1), [-1, n_atoms, self.n_ang * len(self.element_pairs)])
+
+        return tf.reshape(tf.concat([radial, angular], axis=-1), [-1, n_atoms * self.n_feat])
+
+    def __params(self):
+        """
+        This function collects the parameters needed to calculate the symmetry functions in a dictionary, so that they
+        can be sent to other processes.
+
+        :return: dictionary
+        """
+        # Masks of shape (n_atoms,) that are 1 for the atoms of each element
+        element_masks = np.array([[float(label == ele) for label in self.atom_labels] for ele in self.elements])
+
+        rad = np.array([(eta, r_s) for eta in self.eta_rad for r_s in self.r_s])
+        ang = np.array([(eta, zeta, lam) for eta in self.eta_ang for zeta in self.zeta for lam in self.lambdas])
+
+        # Masks of shape (n_atoms, n_atoms) that are 1 where atoms j and k are a pair of the right elements
+        pair_masks = []
+        for ele_1, ele_2 in self.element_pairs:
+            mask_1 = element_masks[self.elements.index(ele_1)]
+            mask_2 = element_masks[self.elements.index(ele_2)]
+            if ele_1 == ele_2:
+                pair_masks.append(np.outer(mask_1, mask_2))
+            else:
+                pair_masks.append(np.outer(mask_1, mask_2) + np.outer(mask_2, mask_1))
+
+        # Index of the element of each atom and index of each pair of elements, used with the neighbour lists
+        element_idx = np.array([self.elements.index(label) for label in self.atom_labels])
+        pair_idx = np.zeros((len(self.elements), len(self.elements)), dtype=int)
+        for ii, (ele_1, ele_2) in enumerate(self.element_pairs):
+            pair_idx[self.elements.index(ele_1), self.elements.index(ele_2)] = ii
+            pair_idx[self.elements.index(ele_2), self.elements.index(ele_1)] = ii
+
+        return {'r_cut': self.r_cut, 'element_masks': element_masks, 'pair_masks': np.array(pair_masks), 'rad': rad,
+                'ang': ang, 'element_idx': element_idx, 'pair_idx': pair_idx}
+
+
+def cutoff_function(R, r_cut):
+    """
+    This function calculates the cosine cut off function.
+
+    :R: numpy array of distances
+    :r_cut: float
+    :return: numpy array of the same shape as R
+    """
+    return np.where(R < r_cut, 0.5 * (np.cos(np.pi * R / r_cut) + 1.0), 0.0)
+
+
+def _symmetry_functions_chunk(args):
+    """
+    This function calculates the symmetry functions for a chunk of configurations. It is a module level function so
+    that it can be used by a multiprocessing pool.
+
+    Only the pairs of atoms closer than r_cut (found with a neighbour list) and the triplets where all three distances
+    are smaller than r_cut contribute, so the memory used grows with the number of neighbours of each atom instead of
+    with n_atoms^3. The atoms of all the configurations of the chunk are numbered consecutively, so that the whole
+    chunk is processed at once.
+
+    :args: tuple with the coordinates, numpy array of shape (n_samples, n_atoms, 3), and the dictionary of parameters
+    :return: numpy array of shape (n_samples, n_atoms, n_features)
+    """
+    coord, params = args
+    n_samples, n_atoms = coord.shape[0], coord.shape[1]
+    n_tot = n_samples * n_atoms
+    r_cut = params['r_cut']
+    n_ele = params['element_masks'].shape[0]
+    n_pairs = params['pair_masks'].shape[0]
+
+    # Pairs i < j closer than r_cut, with the atoms numbered across the whole chunk
+    neighbours = NeighbourList(r_cut)
+    all_i, all_j = [], []
+    for s in range(n_samples):
+        idx_i, idx_j, dist = neighbours.update(coord[s])
+        all_i.append(idx_i + s * n_atoms)
+        all_j.append(idx_j + s * n_atoms)
+    idx_i = np.concatenate(all_i)
+    idx_j = np.concatenate(all_j)
+
+    # Each pair is used in both directions, with the first atom as the centre, and sorted by centre
+    centre = np.concatenate((idx_i, idx_j))
+    neigh = np.concatenate((idx_j, idx_i))
+    order = np.argsort(centre, kind='mergesort')
+    centre, neigh = centre[order], neigh[order]
+
+    flat_coord = coord.reshape((n_tot, 3))
+    element = np.tile(params['element_idx'], n_samples)
+    vec = flat_coord[neigh] - flat_coord[centre]
+    R = np.sqrt(np.sum(vec ** 2, axis=1))
+    fc = cutoff_function(R, r_cut)
+
+    # Radial part: shape (n_tot, n_elements, n_rad)
+    radial = np.zeros((n_tot, n_ele, len(params['rad'])))
+    rad_idx = centre * n_ele + element[neigh]
+    for ii, (eta, r_s) in enumerate(params['rad']):
+        g_ij = np.exp(-eta * (R - r_s) ** 2) * fc
+        radial[:, :, ii] = np.bincount(rad_idx, weights=g_ij, minlength=n_tot * n_ele).reshape((n_tot, n_ele))
+
+    # Triplets: for each directed pair a = (i, j), all the pairs b = (i, k) with the same centre that come after it
+    n_pair_tot = centre.shape[0]
+    group_end = np.cumsum(np.bincount(centre, minlength=n_tot))[centre]
+    n_partners = group_end - np.arange(n_pair_tot) - 1
+    a = np.repeat(np.arange(n_pair_tot), n_partners)
+    first = np.cumsum(n_partners) - n_partners
+    b = a + 1 + np.arange(a.shape[0]) - np.repeat(first, n_partners)
+
+    # Only the triplets where j and k are also closer than r_cut contribute
+    R_jk = np.sqrt(np.sum((flat_coord[neigh[b]] - flat_coord[neigh[a]]) ** 2, axis=1))
+    inside = R_jk < r_cut
+    a, b, R_jk = a[inside], b[inside], R_jk[inside]
+
+    cos_theta = np.sum(vec[a] * vec[b], axis=1) / (R[a] * R[b])
+    fc_ijk = fc[a] * fc[b] * cutoff_function(R_jk, r_cut)
+    R_sq_ijk = R[a] ** 2 + R[b] ** 2 + R_jk ** 2
+    ang_idx = centre[a] * n_pairs + params['pair_idx'][element[neigh[a]], element[neigh[b]]]
+
+    # Angular part: shape (n_tot, n_element_pairs, n_ang)
+    angular = np.zeros((n_tot, n_pairs, len(params['ang'])))
+    for ii, (eta, zeta, lam) in enumerate(params['ang']):
+        g_ijk = 2.0 ** (1.0 - zeta) * (1.0 + lam * cos_theta) ** zeta * np.exp(-eta * R_sq_ijk) * fc_ijk
+        angular[:, :, ii] = np.bincount(ang_idx, weights=g_ijk, minlength=n_tot * n_pairs).reshape((n_tot, n_pairs))
+
+    return np.concatenate((radial.reshape((n_samples, n_atoms, -1)), angular.reshape((n_samples, n_atoms, -1))),
+                          axis=-1)
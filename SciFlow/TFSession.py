@@ -0,0 +1,30 @@
+"""
+This module opens the TensorFlow sessions of the estimators (MLPRegFlow and BPNN), so that the number of threads and
+the pinning of the process to some CPUs are set in the same way for both of them.
+"""
+
+import tensorflow as tf
+
+
+def new_session(graph=None, intra_op_threads=0, inter_op_threads=0, cpu_affinity=None):
+    """
+    This function opens a TensorFlow session that uses intra_op_threads and inter_op_threads threads. If cpu_affinity
+    is given, the process is first pinned to those CPUs (this needs psutil).
+
+    :graph: tf.Graph or None, default None - graph launched in the session. If None, the default graph is used.
+    :intra_op_threads: int, default 0 - number of threads used to run a single operation (0 lets TensorFlow choose)
+    :inter_op_threads: int, default 0 - number of operations run in parallel (0 lets TensorFlow choose)
+    :cpu_affinity: list of int or None, default None - CPUs to which the process is pinned
+    :return: tf.Session
+    """
+    if cpu_affinity is not None:
+        # psutil works with both python 2 and 3, it is only needed when the process is pinned
+        import psutil
+        if not hasattr(psutil.Process, 'cpu_affinity'):
+            raise NotImplementedError("Pinning the process to some CPUs is not supported on this platform.")
+        psutil.Process().cpu_affinity(list(cpu_affinity))
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                            inter_op_parallelism_threads=inter_op_threads)
+
+    return tf.Session(graph=graph, config=config)
@@ -3,12 +3,13 @@ import ImportData
 
 class tewDescriptor:
 
-    def __init__(self, matrixX):
+    def __init__(self, matrixX, dtype=np.float64):
         self.rawX = matrixX
+        self.dtype = dtype
         self.n_atoms = int(len(self.rawX[0]) / 4)
         self.n_samples = len(self.rawX)
         self.n_distances = int(self.n_atoms * (self.n_atoms - 1) * 0.5)
-        self.tew = np.zeros((self.n_samples,self.n_distances))
+        self.tew = np.zeros((self.n_samples,self.n_distances), dtype=self.dtype)
 
     def generateTew(self):
 
@@ -0,0 +1,74 @@
+"""
+This module contains the functions used to make the plots of the other modules. The plotting packages (matplotlib,
+seaborn and pandas) are only imported when a plot is actually made, so that the modules can be imported quickly on
+machines that don't have a display.
+
+The plots can be made in two ways:
+
+1. Interactively: the plot is shown with ``plt.show()`` (and optionally also written to a file).
+
+2. Headless: the plot is drawn on a figure that is not attached to any display and it is written to a file in a
+background thread, so that the calculation carries on while the figure is rendered. The function wait_plots() can be
+called to wait for all the files to be written.
+"""
+
+import threading
+
+_plot_threads = []
+
+
+def make_plot(draw, file_name=None, headless=False, figsize=(6, 6)):
+    """
+    This function makes a plot with one set of axes. The plot itself is made by the function draw, which takes a
+    matplotlib axes object as its only argument.
+
+    :draw: function that takes a matplotlib.axes.Axes and draws on it
+    :file_name: string - name of the file where to write the plot. It is required in headless mode.
+    :headless: bool - if True the plot is written to file_name in a background thread instead of being shown
+    :figsize: tuple of 2 floats
+    :return: the thread writing the plot in headless mode, None otherwise
+    """
+    if headless:
+        if file_name is None:
+            raise ValueError("A file name is needed to make a plot in headless mode.")
+        thread = threading.Thread(target=_write_plot, args=(draw, file_name, figsize))
+        thread.start()
+        _plot_threads.append(thread)
+        return thread
+
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=figsize)
+    draw(ax)
+    if file_name is not None:
+        fig.savefig(file_name)
+    plt.show()
+
+    return None
+
+
+def _write_plot(draw, file_name, figsize):
+    """
+    This function draws a plot on a figure that is not managed by pyplot (so it never needs a display and it is safe
+    to use outside the main thread) and writes it to a file.
+
+    :draw: function that takes a matplotlib.axes.Axes and draws on it
+    :file_name: string
+    :figsize: tuple of 2 floats
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    draw(ax)
+    fig.savefig(file_name)
+
+
+def wait_plots():
+    """
+    This function waits until all the plots that are being written in headless mode have been written to file.
+    """
+    while _plot_threads:
+        _plot_threads.pop().join()
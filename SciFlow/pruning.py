@@ -14,9 +14,8 @@ import numpy as np
 from sklearn.cluster import KMeans
 from sklearn.cluster import MiniBatchKMeans
 from sklearn.metrics.pairwise import euclidean_distances
-import matplotlib.pyplot as plt
-import pandas as pd
-import seaborn as sns
+import os
+import plotting
 
 class Pruning():
     """
@@ -25,16 +24,22 @@ class Pruning():
     It takes as an input the X and the y part of the data. The X part can contain only the coordinates (not the atom labels).
     The y part contains the energies.
 
-    It has been created with the idea that it will be used in a jupyter notebook.
+    It has been created with the idea that it will be used in a jupyter notebook. When it is run as a batch job, the
+    headless mode can be used: the plots are then written to png files in plot_dir in the background instead of being
+    shown, so the job never waits for a display.
 
     :X: array of shape (n_samples, dim x n_atoms)
     :y: numpy array of shape (n_samples,)
+    :headless: bool, default False
+    :plot_dir: string, default '.' - directory where the plots are written in headless mode
     """
 
-    def __init__(self, X, y):
+    def __init__(self, X, y, headless=False, plot_dir='.'):
         self.X = X
         self.y = y
         self.dim = X.shape[1]
+        self.headless = headless
+        self.plot_dir = plot_dir
 
 
     def elbow(self,n_centres):
@@ -66,12 +71,16 @@ class Pruning():
     def get_X(self):
         return self.X
 
-    def clustering(self, n_clusters):
+    def clustering(self, n_clusters, chunk_size=1000):
         """
         This function clusters the data into n_clusters and returns the indexes of the data points in each cluster that
         are closest to the centre.
 
+        The closest sample to each centre is found by going through the data in chunks of chunk_size samples, so that
+        only a (chunk_size, n_clusters) matrix of distances is held in memory at any time.
+
         :n_clusters: int
+        :chunk_size: int, default 1000
         :return: array of int
         """
         if n_clusters < 5000:
@@ -79,58 +88,98 @@ class Pruning():
         else:
             kmeans = MiniBatchKMeans(n_clusters=n_clusters).fit(self.X)
 
-        clusters_idx = kmeans.predict(self.X)  # indices of which cluster each point belongs to
         self.centres = kmeans.cluster_centers_
-        dist_mat = kmeans.transform(self.X)  # (n_samples, n_clusters) matrix of distances of each sample to each centre
-
-        self.idx_clust = np.zeros((n_clusters,))
 
-        for i in range(n_clusters):
-            self.idx_clust[i] = np.argmin(dist_mat[:,i])
+        # Running minimum distance of any sample to each centre and the index of that sample
+        best_dist = np.full((n_clusters,), np.inf)
+        self.idx_clust = np.zeros((n_clusters,), dtype=int)
 
-        self.idx_clust = self.idx_clust.astype(int)
+        for start in range(0, self.X.shape[0], chunk_size):
+            self._update_closest(self.X[start:start + chunk_size], start, best_dist, self.idx_clust)
 
-        self.X_cl = np.zeros((len(self.idx_clust), self.X.shape[1]))
-        for i, item in enumerate(self.idx_clust):
-            self.X_cl[i, :] = self.X[item, :]
+        self.X_cl = self.X[self.idx_clust]
 
         if self.dim == 2:
             self.__plot_centres()
 
         return self.idx_clust
 
+    def _update_closest(self, X_chunk, offset, best_dist, best_idx):
+        """
+        This function updates in place the index of the sample closest to each centre with the samples in X_chunk.
+
+        :X_chunk: array of shape (chunk_size, n_features)
+        :offset: int - index of the first sample of X_chunk in the full data set
+        :best_dist: array of shape (n_clusters,) of the smallest squared distances found so far
+        :best_idx: array of shape (n_clusters,) of the indexes of the closest samples found so far
+        :return: boolean array of shape (n_clusters,) that is True for the centres that were updated
+        """
+        # (chunk_size, n_clusters) matrix of squared distances of each sample in the chunk to each centre
+        dist_mat = euclidean_distances(X_chunk, self.centres, squared=True)
+        chunk_idx = np.argmin(dist_mat, axis=0)
+        chunk_dist = dist_mat[chunk_idx, np.arange(dist_mat.shape[1])]
+
+        is_closer = chunk_dist < best_dist
+        best_dist[is_closer] = chunk_dist[is_closer]
+        best_idx[is_closer] = chunk_idx[is_closer] + offset
+
+        return is_closer
+
+    def __plot(self, draw, file_name, figsize=(6, 6)):
+        """
+        This function either shows a plot or, in headless mode, writes it to a file in plot_dir in the background.
+
+        :draw: function that takes a matplotlib axes object and draws on it
+        :file_name: string
+        :figsize: tuple of 2 floats
+        """
+        if self.headless:
+            plotting.make_plot(draw, file_name=os.path.join(self.plot_dir, file_name), headless=True, figsize=figsize)
+        else:
+            plotting.make_plot(draw, figsize=figsize)
+
     def __plot_centres(self):
 
-        fig, ax = plt.subplots(figsize=(6, 6))
-        ax.scatter(self.X[:,0],self.X[:,1], label="Points", color="yellow")
-        ax.scatter(self.centres[:,0],self.centres[:,1], label="Centres", color="black")
-        ax.scatter(self.X_cl[:, 0], self.X_cl[:, 1], label="Points to keep", color="red")
-        ax.set_xlabel('x1')
-        ax.set_ylabel('x2')
-        ax.legend()
-        plt.show()
+        X, centres, X_cl = self.X, self.centres, self.X_cl
+
+        def draw(ax):
+            ax.scatter(X[:,0],X[:,1], label="Points", color="yellow")
+            ax.scatter(centres[:,0],centres[:,1], label="Centres", color="black")
+            ax.scatter(X_cl[:, 0], X_cl[:, 1], label="Points to keep", color="red")
+            ax.set_xlabel('x1')
+            ax.set_ylabel('x2')
+            ax.legend()
+
+        self.__plot(draw, "centres.png")
 
     def __plot_fft(self):
 
-        fig, ax = plt.subplots(figsize=(6, 6))
-        ax.scatter(self.X[:,0],self.X[:,1], label="Points", color="yellow")
-        ax.scatter(self.centres[:, 0], self.centres[:, 1], label="Centres", color="black")
-        ax.scatter(self.X_fft[:, 0], self.X_fft[:, 1], label="Points to keep", color="red")
-        ax.set_xlabel('x1')
-        ax.set_ylabel('x2')
-        ax.legend()
-        plt.show()
+        X, centres, X_fft = self.X, self.centres, self.X_fft
+
+        def draw(ax):
+            ax.scatter(X[:,0],X[:,1], label="Points", color="yellow")
+            ax.scatter(centres[:, 0], centres[:, 1], label="Centres", color="black")
+            ax.scatter(X_fft[:, 0], X_fft[:, 1], label="Points to keep", color="red")
+            ax.set_xlabel('x1')
+            ax.set_ylabel('x2')
+            ax.legend()
+
+        self.__plot(draw, "fft.png")
 
     def __plot_elbow(self,n_centres,tot_sum_of_sq):
 
-        k_df = pd.DataFrame()
-        k_df['n of clusters'] = n_centres
-        k_df['sum of squares'] = tot_sum_of_sq
-        fig, ax = plt.subplots(figsize=(10, 7))
-        sns.pointplot(x="n of clusters", y="sum of squares", data=k_df)
-        ax.set_ylabel('Sum of distance squares')
-        ax.set_xlabel('Number of clusters')
-        plt.show()
+        def draw(ax):
+            import pandas as pd
+            import seaborn as sns
+
+            k_df = pd.DataFrame()
+            k_df['n of clusters'] = n_centres
+            k_df['sum of squares'] = tot_sum_of_sq
+            sns.pointplot(x="n of clusters", y="sum of squares", data=k_df, ax=ax)
+            ax.set_ylabel('Sum of distance squares')
+            ax.set_xlabel('Number of clusters')
+
+        self.__plot(draw, "elbow.png", figsize=(10, 7))
 
     def fft_idx(self, n_points, save=False):
         """
@@ -170,11 +219,131 @@ class Pruning():
         if save == True:
             np.save("idx_fft.npy",self.idx_fft)
 
-        if self.dim == 2:
+        if self.dim == 2 and self.X is not None:
             self.__plot_fft()
 
         return self.idx_fft
 
+class StreamingPruning(Pruning):
+    """
+    This class does the same pruning as the class Pruning, but the data set is never loaded in memory all at once. The
+    descriptors are read in chunks from a list of arrays or .npy files (which are memory mapped), so that it can be used
+    on data sets that are larger than the available memory.
+
+    The clustering is always done with mini-batch k-means, updated with one call of partial_fit per chunk. The sample
+    closest to each centre is then kept as a running best while going through the chunks, so only the representative
+    points (and not the whole data set) are stored.
+
+    :sources: list of numpy arrays or of paths to .npy files, each of shape (n_samples_i, n_features)
+    :chunk_size: int, default 10000 - it has to be larger than the number of clusters
+    :headless: bool, default False
+    :plot_dir: string, default '.' - directory where the plots are written in headless mode
+    """
+
+    def __init__(self, sources, chunk_size=10000, headless=False, plot_dir='.'):
+        self.sources = sources
+        self.chunk_size = chunk_size
+        self.X = None
+        self.y = None
+        self.headless = headless
+        self.plot_dir = plot_dir
+        self.dim = self.__load(sources[0]).shape[1]
+
+    def __load(self, source):
+        """
+        This function returns the array contained in a source. If the source is the path to a .npy file, the file is
+        memory mapped rather than read.
+
+        :source: numpy array or string
+        :return: numpy array of shape (n_samples_i, n_features)
+        """
+        if isinstance(source, str):
+            return np.load(source, mmap_mode='r')
+        return source
+
+    def __chunks(self):
+        """
+        This generator goes through all the sources in order and yields them in chunks of at most chunk_size samples.
+
+        :return: tuples of the index of the first sample of the chunk in the whole data set and the chunk (numpy array
+            of shape (chunk_size, n_features))
+        """
+        offset = 0
+        for source in self.sources:
+            X_source = self.__load(source)
+            for start in range(0, X_source.shape[0], self.chunk_size):
+                chunk = np.asarray(X_source[start:start + self.chunk_size], dtype=float)
+                yield offset + start, chunk
+            offset += X_source.shape[0]
+
+    def clustering(self, n_clusters, n_passes=1, single_pass=False):
+        """
+        This function clusters the data into n_clusters and returns the indexes (in the whole data set) of the samples
+        that are closest to each centre.
+
+        By default the centres are first fitted going n_passes times over the data and then the closest samples are
+        found with one more pass. If single_pass is True, the closest samples are tracked while the centres are being
+        fitted, so that the data is only read once. In this case the representative points are approximate, since the
+        centres keep moving while the data is read.
+
+        :n_clusters: int
+        :n_passes: int, default 1
+        :single_pass: bool, default False
+        :return: array of int
+        """
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters)
+
+        best_dist = np.full((n_clusters,), np.inf)
+        self.idx_clust = np.zeros((n_clusters,), dtype=int)
+        self.X_cl = np.zeros((n_clusters, self.dim))
+
+        for i in range(n_passes):
+            for offset, chunk in self.__chunks():
+                kmeans.partial_fit(chunk)
+                if single_pass:
+                    self.centres = kmeans.cluster_centers_
+                    # The centres have moved, so the distances of the current representatives have to be updated
+                    is_set = np.isfinite(best_dist)
+                    best_dist[is_set] = np.sum((self.X_cl[is_set] - self.centres[is_set]) ** 2, axis=1)
+                    self.__update_representatives(chunk, offset, best_dist)
+
+        self.centres = kmeans.cluster_centers_
+
+        if not single_pass:
+            for offset, chunk in self.__chunks():
+                self.__update_representatives(chunk, offset, best_dist)
+
+        return self.idx_clust
+
+    def __update_representatives(self, chunk, offset, best_dist):
+        """
+        This function updates the indexes and the copies of the samples closest to each centre with the samples of a
+        chunk.
+
+        :chunk: numpy array of shape (chunk_size, n_features)
+        :offset: int - index of the first sample of chunk in the whole data set
+        :best_dist: array of shape (n_clusters,) of the smallest squared distances found so far
+        """
+        is_closer = self._update_closest(chunk, offset, best_dist, self.idx_clust)
+        self.X_cl[is_closer] = chunk[self.idx_clust[is_closer] - offset]
+
+    def prune(self, n_clusters, n_points, n_passes=1, single_pass=False, save=False):
+        """
+        This function runs the clustering followed by the furthest first traversal of the representative points. It
+        returns the indexes in the whole data set of the samples to put into the training set.
+
+        :n_clusters: int
+        :n_points: int (smaller than n_clusters)
+        :n_passes: int, default 1
+        :single_pass: bool, default False
+        :save: bool - whether to save the indexes of the representative points that are kept to idx_fft.npy
+        :return: array of int
+        """
+        self.clustering(n_clusters, n_passes=n_passes, single_pass=single_pass)
+        idx_fft = self.fft_idx(n_points, save=save)
+
+        return self.idx_clust[idx_fft]
+
 if __name__ == "__main__":
 
     from sklearn.datasets.samples_generator import make_blobs